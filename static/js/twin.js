@@ -5,20 +5,13 @@ app.controller('TwinController', function($scope, $http, $timeout) {
     $scope.preference = null;
     $scope.somechange = false;
 
-    // Get the list of all the students
-    $http.get('/api/students').then(function(response) {
-        $scope.students = response.data;
-    });
-
-    // Get the user information
-    $http.get('/api/user').then(function(response) {
-        $scope.user = response.data;
-    });
-
-    // Get the user preference information
-    $http.get('/api/preference').then(function(response) {
-        $scope.preference = response.data;
-        $scope.selected = response.data;
+    // Get the user, its preference and the students that already chose us in one request,
+    // the other students are searched while typing
+    $http.get('/api/bootstrap').then(function(response) {
+        $scope.user = response.data.user;
+        $scope.students = response.data.students;
+        $scope.preference = response.data.preference;
+        $scope.selected = response.data.preference;
     });
 
     $scope.select = function(student) {
@@ -26,43 +19,43 @@ app.controller('TwinController', function($scope, $http, $timeout) {
         $scope.somechange = true;
     }
 
-    // Fill the autocomplete
-    $scope.$watch('students', function(students) {
-        if(students) {
-            var source = students.map(function(student) {
-                return {'value': student.name, 'student': student};
+    // Fill the autocomplete with students searched on the server
+    $( "#student" ).autocomplete({
+        source: function(request, response) {
+            $http.get('/api/students/search', {params: {q: request.term, limit: 20}}).then(function(result) {
+                response(result.data.map(function(student) {
+                    return {'value': student.name, 'student': student};
+                }));
+            }, function() {
+                response([]);
             });
+        },
+        delay: 100,
+        select: function(event, ui) {
+            // Call with timeout to make sure the whole $digest cycle keeps working
+            $timeout(function() {
+                $scope.selected = ui.item.student;
+                $scope.somechange = true;
+            })
+        }
+    }).data("ui-autocomplete")._renderItem = function( ul, item ) {
+        var li = $("<li>");
+        if(item.student.reciprocal) {
+            li.addClass('reciprocal');
+        }
+        li.append( item.label )
+            .appendTo( ul );
+        return li;
+    }
 
-            $( "#student" ).autocomplete({
-                source: source,
-                delay: 0,
-                select: function(event, ui) {
-                    // Call with timeout to make sure the whole $digest cycle keeps working
-                    $timeout(function() {
-                        $scope.selected = ui.item.student;
-                        $scope.somechange = true;
-                    })
-                }
-            }).data("ui-autocomplete")._renderItem = function( ul, item ) {
-                var li = $("<li>");
-                if(item.student.reciprocal) {
-                    li.addClass('reciprocal');
-                }
-                li.append( item.label )
-                    .appendTo( ul );
-                return li;
-            }
-
-            $('#student').on('input change', function(e) {
-                if($(this).val() === '') {
-                    $timeout(function() {
-                        $scope.somechange = true;
-                        $scope.selected = null;
-                    })
-                }
+    $('#student').on('input change', function(e) {
+        if($(this).val() === '') {
+            $timeout(function() {
+                $scope.somechange = true;
+                $scope.selected = null;
             })
         }
-    });
+    })
 
     $scope.save = function() {
         if($scope.selected !== $scope.preference) {
@@ -1,9 +1,17 @@
 from django.contrib import admin
+from django.contrib.admin.actions import delete_selected
 from django.conf.urls import url
-from django.http import HttpResponse
+from django.http import HttpResponse, FileResponse
 from django.shortcuts import render
-from .models import Student, Preference
-import settings, csv, StringIO, xlsxwriter, io, re, types, json
+from django.contrib import messages
+from django.db import transaction
+from django.core.cache import cache
+from django.db.models import Case, When, Value, CharField
+from .models import Student, Preference, Twin, bump_students_version
+import instrumentation
+import settings, csv, StringIO, xlsxwriter, io, re, types, json, tempfile, os, time, hashlib, threading
+from collections import OrderedDict, namedtuple
+from multiprocessing.pool import ThreadPool
 from constance import config
 
 # Load the Google API's
@@ -11,11 +19,99 @@ import httplib2
 from apiclient import discovery
 from oauth2client.file import Storage
 
+class DiscoveryCache(object):
+    """
+    Keeps the Google API discovery documents on disk, so building the API
+    services does not have to download them again in every process.
+    Implements the cache interface of `discovery.build`.
+    """
+    def __init__(self, directory, max_age=24 * 60 * 60):
+        self.directory = directory
+        self.max_age = max_age
+
+    def path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url).hexdigest() + '.json')
+
+    def get(self, url):
+        try:
+            if time.time() - os.path.getmtime(self.path(url)) < self.max_age:
+                with open(self.path(url)) as f:
+                    return f.read()
+        except (IOError, OSError):
+            pass
+        return None
+
+    def set(self, url, content):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            # Write to a temporary file first so other processes never read half a document
+            fd, temp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.rename(temp_path, self.path(url))
+        except (IOError, OSError):
+            pass
+
 class GoogleDrive(object):
-    def __init__(self):
-        self.http = Storage(settings.BASE_DIR + '/google_credentials.json').get().authorize(httplib2.Http())
-        self.drive = discovery.build('drive', 'v3', http=self.http)
-        self.sheets = discovery.build('sheets', 'v4', http=self.http)
+    """
+    Access to the Google Drive and Sheets API's.
+
+    The credentials are only read and the API services only built the first
+    time they are used, so importing the admin does not do any Google work.
+    The services can also be passed in directly.
+
+    With `threads` > 1 the sheets of a spreadsheet are fetched concurrently,
+    every request is retried `retries` times with exponential backoff on
+    rate limiting and server errors.
+    """
+    def __init__(self, drive=None, sheets=None, threads=1, retries=3):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.credentials = None
+        self.drive_service = drive
+        self.sheets_service = sheets
+        self.threads = threads
+        self.retries = retries
+
+    def connect(self):
+        with self.lock:
+            if self.drive_service is not None and self.sheets_service is not None:
+                return
+
+            self.credentials = Storage(settings.BASE_DIR + '/google_credentials.json').get()
+            http = self.credentials.authorize(httplib2.Http())
+            cache = DiscoveryCache(settings.GOOGLE_DISCOVERY_CACHE_DIR)
+
+            if self.drive_service is None:
+                self.drive_service = discovery.build('drive', 'v3', http=http, cache=cache)
+            if self.sheets_service is None:
+                self.sheets_service = discovery.build('sheets', 'v4', http=http, cache=cache)
+
+    @property
+    def drive(self):
+        if self.drive_service is None:
+            self.connect()
+        return self.drive_service
+
+    @property
+    def sheets(self):
+        if self.sheets_service is None:
+            self.connect()
+        return self.sheets_service
+
+    def thread_http(self):
+        """
+        An authorized Http object for the current thread, httplib2 is not thread-safe.
+        Returns None (use the Http of the service) when the services were passed in.
+        """
+        if self.credentials is None:
+            return None
+
+        if not hasattr(self.local, 'http'):
+            self.local.http = self.credentials.authorize(httplib2.Http())
+        return self.local.http
 
     def get_spreadsheets(self):
         """
@@ -25,69 +121,158 @@ class GoogleDrive(object):
            'webViewLink': <string: A url where the user can edit the spreadsheet in a browser>
         }]
         """
-        return self.drive.files().list(
+        return self.execute(self.drive.files().list(
             q="'{0}' in parents and mimeType = 'application/vnd.google-apps.spreadsheet'".format(config.GOOGLE_DRIVE_FOLDER),
             fields="files(id, name, webViewLink)",
             orderBy="name"
-            ).execute()['files']
+            ))['files']
+
+    def get_modified_time(self, spreadsheet_id):
+        """
+        Get the time the spreadsheet was last changed, as an RFC 3339 string
+        """
+        return self.execute(self.drive.files().get(
+            fileId=spreadsheet_id,
+            fields="modifiedTime"
+            ))['modifiedTime']
 
     def get_sheets(self, spreadsheet_id):
-        worksheets = self.sheets.spreadsheets().get(
-            spreadsheetId=spreadsheet_id).execute()['sheets']
+        worksheets = self.execute(self.sheets.spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            fields="sheets/properties/title"))['sheets']
 
         return [s['properties']['title'] for s in worksheets]
 
     def get_students(self, spreadsheet_id):
         """
-        Return an array with all the students in the sheet, ordered by
+        Return an array with all the students in the sheet, ordered by sheet
 
         like this:
-        [{'title': <string: name for the term>, 'students': [
-                {'studentnumber': <int>, 'name': <string>, 'email': <string>},
-                ...
-             },
-             ...
+        [
+            {'student_number': <int>, 'name': <string>, 'sheet': <string>, 'email': <string>},
+            ...
+        ]
+
+        Only the formatted values of columns A-E of every sheet are fetched,
+        in a single request or with one request per sheet in parallel
         """
-        worksheets = self.sheets.spreadsheets().get(
+        sheet_titles = self.get_sheets(spreadsheet_id)
+        ranges = [u"'{0}'!A2:E".format(title.replace("'", "''")) for title in sheet_titles]
+
+        if self.threads > 1 and len(ranges) > 1:
+            pool = ThreadPool(min(self.threads, len(ranges)))
+            try:
+                # map returns the results in the order of the sheets
+                value_ranges = pool.map(instrumentation.in_current_request(lambda r: self.get_range(spreadsheet_id, r)), ranges)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            value_ranges = self.execute(self.sheets.spreadsheets().values().batchGet(
+                spreadsheetId=spreadsheet_id,
+                ranges=ranges,
+                fields="valueRanges(range,values)")).get('valueRanges', [])
+
+        return parse_students(sheet_titles, value_ranges)
+
+    def get_range(self, spreadsheet_id, range):
+        return self.execute(self.sheets.spreadsheets().values().get(
             spreadsheetId=spreadsheet_id,
-            includeGridData=True).execute()['sheets']
+            range=range,
+            fields="range,values"), http=self.thread_http())
 
-        students = []
-        for sheet in worksheets:
-            sheet_title = sheet['properties']['title']
+    def execute(self, request, http=None):
+        """
+        Execute an API request with retries, counted by twin.instrumentation
+        """
+        instrumentation.count_google_call()
+        return request.execute(http=http, num_retries=self.retries)
 
-            for row in sheet['data'][0]['rowData'][1:]:
-                if 'values' in row:
-                    studentnumber = row['values'][0].get('formattedValue') or ''
+def parse_students(sheet_titles, value_ranges):
+    """
+    Turn the response of a `spreadsheets.values.batchGet` on the range A2:E of
+    the given sheets into the list described at `GoogleDrive.get_students`
+    """
+    students = []
+    for sheet_title, value_range in zip(sheet_titles, value_ranges):
+        for row in value_range.get('values', []):
+            # The API leaves out empty cells at the end of a row
+            row = row + [''] * (5 - len(row))
+            studentnumber, lastname, lastname_prefix, firstname, email = row[:5]
+
+            if studentnumber <> '':
+                try:
+                    name = firstname
+                    if lastname_prefix <> '':
+                        name += ' ' + lastname_prefix
+
+                    if lastname <> '':
+                        name += ' ' + lastname
+
+                    student = {
+                        'student_number': int(studentnumber),
+                        'name': name,
+                        'sheet': sheet_title,
+                        'email': email
+                    }
+                    students.append(student)
+                except ValueError:
+                    pass
 
-                    if studentnumber <> '':
-                        try:
-                            firstname = row['values'][3].get('formattedValue') or ''
-                            lastname_prefix = row['values'][2].get('formattedValue') or ''
-                            lastname = row['values'][1].get('formattedValue') or ''
-                            email = row['values'][4].get('formattedValue') or ''
+    return students
+
+class CachedGoogleDrive(object):
+    """
+    Keeps the students of a spreadsheet in the Django cache, so reloading the
+    admin pages does not download all the grid data again.
 
-                            name = firstname
-                            if lastname_prefix <> '':
-                                name += ' ' + lastname_prefix
+    Entries are keyed by the spreadsheet id and its Drive modifiedTime, so an
+    edit in the spreadsheet is picked up on the next request. Only the
+    `max_entries` most recently used spreadsheets are kept.
+    """
+    INDEX_KEY = 'twin:googledrive:students'
+
+    def __init__(self, drive, timeout, max_entries):
+        self.drive = drive
+        self.timeout = timeout
+        self.max_entries = max_entries
 
-                            if lastname <> '':
-                                name += ' ' + lastname
+    def get_spreadsheets(self):
+        return self.drive.get_spreadsheets()
 
+    def get_students(self, spreadsheet_id, refresh=False):
+        """
+        Same as `GoogleDrive.get_students`, pass `refresh=True` to bypass the cache
+        """
+        key = 'twin:googledrive:students:{0}:{1}'.format(
+            spreadsheet_id, self.drive.get_modified_time(spreadsheet_id))
 
-                            student = {
-                                'student_number': int(studentnumber),
-                                'name': name,
-                                'sheet': sheet_title,
-                                'email': email
-                            }
-                            students.append(student)
-                        except:
-                            pass
+        students = None if refresh else cache.get(key)
+        if students is None:
+            students = self.drive.get_students(spreadsheet_id)
+            cache.set(key, students, self.timeout)
 
+        self.mark_used(spreadsheet_id, key)
         return students
 
-googledrive = GoogleDrive()
+    def mark_used(self, spreadsheet_id, key):
+        """
+        Move the spreadsheet to the front of the LRU index and evict the
+        least recently used entries, and older versions of this spreadsheet
+        """
+        index = cache.get(self.INDEX_KEY, [])
+        outdated = [k for s, k in index if s == spreadsheet_id and k != key]
+        index = [(s, k) for s, k in index if s != spreadsheet_id]
+        evicted = [k for s, k in index[self.max_entries - 1:]]
+
+        if outdated or evicted:
+            cache.delete_many(outdated + evicted)
+        cache.set(self.INDEX_KEY, [(spreadsheet_id, key)] + index[:self.max_entries - 1], None)
+
+googledrive = CachedGoogleDrive(
+    GoogleDrive(threads=settings.GOOGLE_SHEETS_FETCH_THREADS, retries=settings.GOOGLE_API_RETRIES),
+    timeout=settings.GOOGLE_DRIVE_CACHE_TIMEOUT,
+    max_entries=settings.GOOGLE_DRIVE_CACHE_ENTRIES)
 
 def sort_by_sheet(students):
     """
@@ -101,27 +286,41 @@ def sort_by_sheet(students):
     [
         {'sheet': <string>, 'students':
             [
-                {'student_number': <int>, 'name': <string>, 'sheet': <string>},
-                {'student_number': <int>, 'name': <string>, 'sheet': <string>},
+                {'student_number': <int>, 'name': <string>},
+                {'student_number': <int>, 'name': <string>},
                 ...
             ]
         },
         ...
     ]
     """
-    seen = set()
-    sheets = [s['sheet'] for s in students if not (s['sheet'] in seen or seen.add(s['sheet']))]
+    return [{'sheet': sheet, 'students': [without_sheet(s) for s in sheet_students]}
+            for sheet, sheet_students in group_by_sheet(students)]
 
-    def without_sheet(student):
-        student = dict(student)
-        del student['sheet']
-        return student
+def without_sheet(student):
+    student = dict(student)
+    del student['sheet']
+    return student
 
-    students = [{'sheet': sheet, 'students':
-        [without_sheet(s) for s in students if s['sheet'] == sheet]
-    } for sheet in sheets]
+def group_by_sheet(students):
+    """
+    Group the students by sheet in a single pass, keeping the order in which
+    the sheets and the students appear, like:
+    [
+        (<string: sheet>, [<student>, <student>, ...]),
+        ...
+    ]
+    """
+    groups = {}
+    sheets = []
+    for student in students:
+        group = groups.get(student['sheet'])
+        if group is None:
+            group = groups[student['sheet']] = []
+            sheets.append(student['sheet'])
+        group.append(student)
 
-    return students
+    return [(sheet, groups[sheet]) for sheet in sheets]
 
 def get_difference(all_students):
     """
@@ -139,73 +338,131 @@ def get_difference(all_students):
         ...
     ]
     """
-    twin_students = list(Student.objects.all())
+    # Index the database side by student number, streaming plain tuples so
+    # no model instances are built. Ordered, so deletions keep the name order.
+    twin_students = OrderedDict(
+        (student_number, (name, email))
+        for student_number, name, email
+        in Student.objects.values_list('student_number', 'name', 'email').iterator())
 
     changed_students = []
-    deleted_students = []
     for student in all_students:
-        student['change'] = 'insert'
-
-        # Try to look up the student in twin_students
-        for twin_student in twin_students:
-            if twin_student.student_number == student['student_number']:
-                if twin_student.name == student['name'] and twin_student.email == student['email']:
-                    student['change'] = 'nothing'
-                else:
-                    student['change'] = 'update'
+        twin_student = twin_students.get(student['student_number'])
 
-                break
+        if twin_student is None:
+            student['change'] = 'insert'
+        elif twin_student == (student['name'], student['email']):
+            student['change'] = 'nothing'
+        else:
+            student['change'] = 'update'
 
         if student['change'] != 'nothing':
             changed_students.append(student)
 
-    all_student_numbers = [s['student_number'] for s in all_students]
+    all_student_numbers = set(s['student_number'] for s in all_students)
     deleted_students = [
-        {'student_number': s.student_number, 'name': s.name}
-        for s in twin_students
-        if s.student_number not in all_student_numbers]
+        {'student_number': student_number, 'name': name}
+        for student_number, (name, email) in twin_students.iteritems()
+        if student_number not in all_student_numbers]
 
     return changed_students, deleted_students
 
+"""
+A mutual preference between two students, `student` always has the lowest student number.
+Both are a `PairStudent` so the name and email are available without extra queries.
+"""
+Pair = namedtuple('Pair', ['student', 'preference_for'])
+PairStudent = namedtuple('PairStudent', ['student_number', 'name', 'email'])
+
 def get_pairs(all_students):
     """
-    Get a list of all the pairs that are present in the students provided as a list of Preference objects
+    Get a list of all the pairs that are present in the students provided as a list of `Pair` tuples,
+    ordered by the student number of the first student
     """
-    all_student_numbers = [s['student_number'] for s in all_students]
+    all_student_numbers = set(s['student_number'] for s in all_students)
+
+    twins = Twin.objects.active().order_by('student1_id').values_list(
+        'student1_id', 'student1__name', 'student1__email',
+        'student2_id', 'student2__name', 'student2__email')
 
-    all_pairs = Preference.objects.raw("""
-            SELECT id, student_id, preference_for_id
-            FROM twin_preference AS tp
-            WHERE EXISTS(
-                SELECT 1
-                FROM twin_preference AS tp2
-                WHERE tp.student_id = tp2.preference_for_id
-                AND tp.preference_for_id = tp2.student_id)
-            AND student_id < preference_for_id
-            ORDER BY student_id""")
+    return [Pair(PairStudent(*t[0:3]), PairStudent(*t[3:6]))
+            for t in twins
+            if t[0] in all_student_numbers
+            and t[3] in all_student_numbers]
+
+def chunked(items, size):
+    """
+    Split a list into consecutive lists of at most `size` items
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def apply_import(upserts, deletes, batch_size=500):
+    """
+    Apply the changes confirmed on the import page in bulk, in one transaction.
+
+    `upserts` is a list like:
+    [
+        {'student_number': <int>, 'name': <string>, 'email': <string>},
+        ...
+    ]
+    and `deletes` is a list of student numbers.
 
-    return filter(lambda pref: pref.student.student_number in all_student_numbers and pref.preference_for.student_number in all_student_numbers, all_pairs)
+    New students are inserted with bulk_create, changed students are updated
+    with one UPDATE per chunk and deletes use one student_number__in query per chunk.
 
+    returns the number of affected students like:
+    {'insert': <int>, 'update': <int>, 'delete': <int>}
+    """
+    counts = {'insert': 0, 'update': 0, 'delete': 0}
+    upserts = OrderedDict((s['student_number'], s) for s in upserts)
+
+    with transaction.atomic():
+        for chunk in chunked(list(upserts), batch_size):
+            existing = dict(
+                (student_number, (name, email))
+                for student_number, name, email
+                in Student.objects.filter(student_number__in=chunk).values_list('student_number', 'name', 'email'))
+
+            inserts = [Student(student_number=n, name=upserts[n]['name'], email=upserts[n]['email'])
+                       for n in chunk if n not in existing]
+            updates = [upserts[n] for n in chunk
+                       if n in existing and existing[n] != (upserts[n]['name'], upserts[n]['email'])]
+
+            if inserts:
+                Student.objects.bulk_create(inserts)
+                counts['insert'] += len(inserts)
+
+            if updates:
+                Student.objects.filter(student_number__in=[s['student_number'] for s in updates]).update(
+                    name=Case(*[When(student_number=s['student_number'], then=Value(s['name'])) for s in updates], output_field=CharField()),
+                    email=Case(*[When(student_number=s['student_number'], then=Value(s['email'])) for s in updates], output_field=CharField()))
+                counts['update'] += len(updates)
+
+        for chunk in chunked(deletes, batch_size):
+            deleted, per_model = Student.objects.filter(student_number__in=chunk).delete()
+            counts['delete'] += per_model.get(Student._meta.label, 0)
+
+        # bulk_create and update do not send the signals that normally do this
+        bump_students_version()
+
+    return counts
+
+@instrumentation.instrumented
 def student_import(request, spreadsheet_id):
     if spreadsheet_id is None:
         return render(request, 'student_import_choose_spreadsheet.html', {'sheets': googledrive.get_spreadsheets()})
 
     if request.method == "POST":
-        for key in request.POST:
-            if key.startswith('student-upsert-'):
-                student_data = json.loads(request.POST[key])
-                Student.objects.update_or_create(
-                    student_number=student_data['student_number'],
-                    defaults={
-                        'name': student_data['name'],
-                        'email': student_data['email'],
-                    })
-
-            if key.startswith('student-delete-'):
-                student_number = int(key.replace('student-delete-', ''))
-                Student.objects.filter(student_number=student_number).delete()
-
-    students, deleted_students = get_difference(googledrive.get_students(spreadsheet_id))
+        upserts = [json.loads(request.POST[key]) for key in request.POST if key.startswith('student-upsert-')]
+        deletes = [int(key.replace('student-delete-', '')) for key in request.POST if key.startswith('student-delete-')]
+
+        counts = apply_import(upserts, deletes)
+        messages.success(request, '{0} studenten toegevoegd, {1} bijgewerkt en {2} verwijderd.'.format(
+            counts['insert'], counts['update'], counts['delete']))
+
+    students, deleted_students = get_difference(
+        googledrive.get_students(spreadsheet_id, refresh='refresh' in request.GET))
     students = sort_by_sheet(students)
     return render(request, 'student_import_confirm_changes.html',
         {'students': students, 'deleted_students': deleted_students})
@@ -243,75 +500,110 @@ The status can be one of three things: (always in the given order)
    These are all the students that are not part of a pair
 """
 def array_excel_output(all_students, sheet):
+    for output_sheet, rows in excel_output_by_sheet(all_students):
+        if output_sheet == sheet:
+            return list(rows)
+
+    return []
+
+def excel_output_by_sheet(all_students):
+    """
+    Generates the output of `array_excel_output` for every sheet at once,
+    in the order the sheets appear in `all_students`, like:
+    (<string: sheet>, <generator: rows of that sheet>),
+    ...
+
+    The pairs are only computed and divided over the sheets once, so the
+    whole spreadsheet takes a single pass over the students and the pairs.
+    """
     pairs = get_pairs(all_students)
-    sheet_student_numbers = [s['student_number'] for s in all_students if s['sheet'] == sheet]
 
+    student_sheets = {}
+    sheet_lookup = {}
+    for student in all_students:
+        student_sheets.setdefault(student['student_number'], set()).add(student['sheet'])
+        sheet_lookup[student['student_number']] = student['sheet']
+
+    # A pair is a 'koppel' on the sheets of both students and a 'mismatch' on the sheets of only one
+    koppels = {}
+    mismatches = {}
     paired_student_numbers = set()
     for pair in pairs:
         paired_student_numbers.add(pair.student.student_number)
         paired_student_numbers.add(pair.preference_for.student_number)
 
-    sheet_lookup = {}
-    for student in all_students:
-        sheet_lookup[student['student_number']] = student['sheet']
+        sheets_a = student_sheets[pair.student.student_number]
+        sheets_b = student_sheets[pair.preference_for.student_number]
+        for sheet in sheets_a & sheets_b:
+            koppels.setdefault(sheet, []).append(pair)
+        for sheet in sheets_a ^ sheets_b:
+            mismatches.setdefault(sheet, []).append(pair)
 
-    output = []
+    for sheet, students in group_by_sheet(all_students):
+        singles = [s for s in students if s['student_number'] not in paired_student_numbers]
+        yield sheet, sheet_excel_output(sheet, koppels.get(sheet, []), mismatches.get(sheet, []),
+                                        singles, sheet_lookup)
+
+def sheet_excel_output(sheet, koppels, mismatches, singles, sheet_lookup):
+    """
+    Generates the rows of a single sheet, as described at `array_excel_output`
+    """
     pair_number = 1
 
     # First do all the 'koppels'
-    for pair in pairs:
-        if pair.student.student_number in sheet_student_numbers \
-            and pair.preference_for.student_number in sheet_student_numbers:
-            output.append(['{0}a'.format(pair_number), pair.student.student_number, pair.student.name, pair.student.email, sheet, 'koppel'])
-            output.append(['{0}b'.format(pair_number), pair.preference_for.student_number, pair.preference_for.name, pair.preference_for.email, sheet, 'koppel'])
-            pair_number += 1
+    for pair in koppels:
+        yield ['{0}a'.format(pair_number), pair.student.student_number, pair.student.name, pair.student.email, sheet, 'koppel']
+        yield ['{0}b'.format(pair_number), pair.preference_for.student_number, pair.preference_for.name, pair.preference_for.email, sheet, 'koppel']
+        pair_number += 1
 
     # Then do all the mismatches
-    for pair in pairs:
-        if (pair.student.student_number in sheet_student_numbers) \
-            ^ (pair.preference_for.student_number in sheet_student_numbers):
-            output.append(['{0}a'.format(pair_number), pair.student.student_number, pair.student.name, student['email'], sheet_lookup[pair.student.student_number], 'mismatch'])
-            output.append(['{0}b'.format(pair_number), pair.preference_for.student_number, pair.preference_for.name, pair.preference_for.email, sheet_lookup[pair.preference_for.student_number], 'mismatch'])
-            pair_number += 1
+    for pair in mismatches:
+        yield ['{0}a'.format(pair_number), pair.student.student_number, pair.student.name, pair.student.email, sheet_lookup[pair.student.student_number], 'mismatch']
+        yield ['{0}b'.format(pair_number), pair.preference_for.student_number, pair.preference_for.name, pair.preference_for.email, sheet_lookup[pair.preference_for.student_number], 'mismatch']
+        pair_number += 1
 
     # Then add all the singles
-    for student in all_students:
-        if student['sheet'] == sheet and student['student_number'] not in paired_student_numbers:
-            output.append([str(pair_number), student['student_number'], student['name'], student['email'], sheet, 'single'])
-            pair_number += 1
-
-    return output
+    for student in singles:
+        yield [str(pair_number), student['student_number'], student['name'], student['email'], sheet, 'single']
+        pair_number += 1
 
-def make_groups(request, spreadsheet_id):
-    if spreadsheet_id is None:
-        return render(request, 'make_groups_choose_spreadsheet.html', {'sheets': googledrive.get_spreadsheets()})
-
-    students = googledrive.get_students(spreadsheet_id)
-
-    seen = set()
-    sheets = [s['sheet'] for s in students if not (s['sheet'] in seen or seen.add(s['sheet']))]
-
-    output = io.BytesIO()
-    workbook = xlsxwriter.workbook.Workbook(output, {'in_memory': True})
+def write_groups_workbook(students, output):
+    """
+    Write the groups of all sheets as an xlsx workbook to the file-like `output`
 
-    for sheet in sheets:
-        excel_output = array_excel_output(students, sheet)
+    The workbook runs in constant memory mode, which flushes every row to a
+    temporary file as soon as the next one is written, so memory use does not
+    grow with the number of students.
+    """
+    workbook = xlsxwriter.workbook.Workbook(output, {'constant_memory': True})
 
+    for sheet, rows in excel_output_by_sheet(students):
         worksheet = workbook.add_worksheet(re.sub(r'[^\w\']', '', sheet))
-        row_i = 0
-        for row in excel_output:
+        for row_i, row in enumerate(rows):
             worksheet.write_row(row_i, 0, row)
-            row_i += 1
 
         worksheet.set_column(0, 0, 3)
         worksheet.set_column(2, 2, 30)
         worksheet.set_column(3, 3, 40)
         worksheet.set_column(4, 4, 14)
     workbook.close()
+
+@instrumentation.instrumented
+def make_groups(request, spreadsheet_id):
+    if spreadsheet_id is None:
+        return render(request, 'make_groups_choose_spreadsheet.html', {'sheets': googledrive.get_spreadsheets()})
+
+    students = googledrive.get_students(spreadsheet_id, refresh='refresh' in request.GET)
+
+    # Small workbooks stay in memory, larger ones are spooled to disk and streamed from there
+    output = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    write_groups_workbook(students, output)
+    size = output.tell()
     output.seek(0)
 
-    response = HttpResponse(output.read(), content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    response = FileResponse(output, content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
     response['Content-Disposition'] = "attachment; filename=twin.xlsx"
+    response['Content-Length'] = size
 
     return response
 
@@ -327,5 +619,33 @@ admin.site.site_header = 'TWIN administratie'
 admin.site.index_template = 'admin_index.html'
 admin.site.get_urls = types.MethodType(get_urls, admin.site)
 
+class PreferenceAdmin(admin.ModelAdmin):
+    """
+    Preferences changed here bypass api_preference, so the twins are synced afterwards
+    """
+    actions = ['delete_selected_and_sync_twins']
+
+    def save_model(self, request, obj, form, change):
+        super(PreferenceAdmin, self).save_model(request, obj, form, change)
+        Twin.objects.sync()
+
+    def delete_model(self, request, obj):
+        super(PreferenceAdmin, self).delete_model(request, obj)
+        Twin.objects.sync()
+
+    def get_actions(self, request):
+        actions = super(PreferenceAdmin, self).get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def delete_selected_and_sync_twins(self, request, queryset):
+        response = delete_selected(self, request, queryset)
+        # No response means the preferences are deleted, otherwise it is the confirmation page
+        if response is None:
+            Twin.objects.sync()
+        return response
+    delete_selected_and_sync_twins.short_description = delete_selected.short_description
+
 admin.site.register(Student)
-admin.site.register(Preference)
+admin.site.register(Preference, PreferenceAdmin)
+admin.site.register(Twin)
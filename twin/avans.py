@@ -2,55 +2,189 @@ from django.contrib.auth import get_user_model, authenticate, login as django_lo
 User = get_user_model()
 from django.http import HttpResponse
 from django.http import HttpResponseRedirect
+from django.shortcuts import render
+from django.core.cache import cache
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 import oauth2 as oauth
-import cgi, json
+import cgi, json, logging, socket, threading
+import httplib2
 import twin.secrets as secrets
+import twin.settings as settings
 from twin.models import Student
 
-REQUEST_TOKEN_URL = 'https://publicapi.avans.nl/oauth/request_token?oauth_callback=http://%s/oauth/callback'
-ACCESS_TOKEN_URL = 'https://publicapi.avans.nl/oauth/access_token'
-AUTHORIZE_URL = 'https://publicapi.avans.nl/oauth/saml.php?oauth_token=%s'
+REQUEST_TOKEN_URL = '/oauth/request_token?oauth_callback=http://%s/oauth/callback'
+ACCESS_TOKEN_URL = '/oauth/access_token'
+AUTHORIZE_URL = '/oauth/saml.php?oauth_token=%s'
+PEOPLE_URL = '/oauth/people/@me'
+STUDENT_NUMBER_URL = '/oauth/studentnummer/'
 
 consumer = oauth.Consumer(secrets.AVANS_KEY, secrets.AVANS_SECRET)
-client = oauth.Client(consumer)
 
-def login(request):
-    resp, content = client.request(REQUEST_TOKEN_URL % request.get_host(), "GET")
+logger = logging.getLogger('twin.avans')
+
+class AvansError(Exception):
+    """
+    The Avans API did not answer in time, or not with what we expected
+    """
+
+class AvansClient(object):
+    """
+    Signs requests to the Avans API with OAuth and sends them over kept-alive connections,
+    so a login does not pay for new TLS handshakes. It is shared by all requests: httplib2
+    is not thread-safe, so every thread has its own Http with its own connections.
+    """
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.signature_method = oauth.SignatureMethod_HMAC_SHA1()
+        self.local = threading.local()
+
+    def http(self):
+        if getattr(self.local, 'timeout', None) != settings.AVANS_API_TIMEOUT:
+            self.local.http = httplib2.Http(timeout=settings.AVANS_API_TIMEOUT)
+            self.local.timeout = settings.AVANS_API_TIMEOUT
+        return self.local.http
+
+    def request(self, url, token=None):
+        # Signed like oauth2.Client does for a GET, with the parameters in the url
+        oauth_request = oauth.Request.from_consumer_and_token(
+            self.consumer, token=token, http_method='GET', http_url=url, body=b'', is_form_encoded=False)
+        oauth_request.sign_request(self.signature_method, self.consumer, token)
+        return self.http().request(oauth_request.to_url(), 'GET')
+
+client = AvansClient(consumer)
+
+def api_request(path, token=None):
+    """
+    Get a path of the Avans API signed with the consumer and `token`, returns the content.
+    Raises AvansError when it fails or takes longer than settings.AVANS_API_TIMEOUT seconds.
+    """
+    try:
+        resp, content = client.request(settings.AVANS_API_URL + path, token)
+    except (socket.error, httplib2.HttpLib2Error) as e:
+        raise AvansError('{0} failed: {1!r}'.format(path, e))
 
     if resp['status'] != '200':
-        raise Exception("Invalid response from oauth")
+        raise AvansError('{0} answered with status {1}'.format(path, resp['status']))
+    return content
+
+"""
+The profile lookups of the logins run in these threads, created when they are first needed
+"""
+pool = None
+pool_lock = threading.Lock()
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = ThreadPool(settings.AVANS_LOGIN_THREADS)
+    return pool
+
+"""
+The browser keeps the username of its last login in this signed cookie, a repeated
+login then uses the cached profile of that user
+"""
+LAST_USER_COOKIE = 'twin_last_user'
+LAST_USER_SALT = 'twin.avans.last_user'
+
+def profile_cache_key(username):
+    return u'twin:avans:profile:{0}'.format(username)
+
+def get_cached_profile(username):
+    """
+    The cached (name, email, is_student) of a user, or None
+    """
+    if not username or not settings.AVANS_PROFILE_CACHE_TIMEOUT:
+        return None
+    return cache.get(profile_cache_key(username))
+
+def cache_profile(username, name, email, is_student):
+    if settings.AVANS_PROFILE_CACHE_TIMEOUT:
+        cache.set(profile_cache_key(username), (name, email, is_student), settings.AVANS_PROFILE_CACHE_TIMEOUT)
+
+def parse_people(content):
+    """
+    The (name, email, is_student) of a response of PEOPLE_URL
+    """
+    try:
+        # Check if the user is an employee or not
+        data = json.loads(content)
+        return data['name']['formatted'], data['emails'][0], data['employee'] <> 'true'
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        raise AvansError('Unexpected profile: {0!r}'.format(e))
+
+def parse_student_number(content):
+    """
+    The (username, student_number) of a response of STUDENT_NUMBER_URL
+    """
+    try:
+        data = json.loads(content)[0]
+        return data['inlognaam'].lower(), int(data['studentnummer'])
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        raise AvansError('Unexpected profile: {0!r}'.format(e))
+
+def get_profile(token, last_username=None):
+    """
+    Get (username, name, email, is_student, student_number) of the user of the access token.
+
+    When `last_username` is the user that logged in last with this browser and its profile
+    is cached, only the username and student number are looked up and the rest comes from
+    the cache, for settings.AVANS_PROFILE_CACHE_TIMEOUT seconds. Otherwise the two lookups
+    run at the same time.
+    """
+    cached = get_cached_profile(last_username)
+    people = get_pool().apply_async(api_request, (PEOPLE_URL, token)) if cached is None else None
+
+    username, student_number = parse_student_number(api_request(STUDENT_NUMBER_URL, token))
+
+    if cached is not None and username == last_username:
+        name, email, is_student = cached
+        return username, name, email, is_student, student_number
+
+    if people is None:
+        # Someone else logs in with this browser
+        people_content = api_request(PEOPLE_URL, token)
+    else:
+        try:
+            people_content = people.get(settings.AVANS_API_TIMEOUT)
+        except TimeoutError:
+            raise AvansError('{0} did not finish in time'.format(PEOPLE_URL))
+
+    name, email, is_student = parse_people(people_content)
+    cache_profile(username, name, email, is_student)
+    return username, name, email, is_student, student_number
+
+def login_error(request, error):
+    logger.warning('Login failed: {0}'.format(error))
+    return render(request, 'login_error.html', status=502)
 
-    request.session['request_token'] = dict(cgi.parse_qsl(content))
+def login(request):
+    try:
+        content = api_request(REQUEST_TOKEN_URL % request.get_host())
+        request_token = dict(cgi.parse_qsl(content))
+        url = settings.AVANS_API_URL + AUTHORIZE_URL % request_token['oauth_token']
+    except (AvansError, KeyError) as e:
+        return login_error(request, e)
 
-    url = AUTHORIZE_URL % (request.session['request_token']['oauth_token'])
+    request.session['request_token'] = request_token
     return HttpResponseRedirect(url)
 
 def callback(request):
-    token = oauth.Token(request.session['request_token']['oauth_token'], request.session['request_token']['oauth_token_secret'])
-    token.set_verifier(request.GET['oauth_verifier'])
-
-    client = oauth.Client(consumer, token)
-
-    resp, content = client.request(ACCESS_TOKEN_URL, "GET")
-    if resp['status'] != '200':
-        raise Exception("Invalid response from Avans.")
-
-    access_token = dict(cgi.parse_qsl(content))
-    token = oauth.Token(access_token['oauth_token'], access_token['oauth_token_secret'])
-    client = oauth.Client(consumer, token)
-
-    # Check if the user is an employee or not
-    resp, content = client.request('https://publicapi.avans.nl/oauth/people/@me', 'GET')
-    data = json.loads(content)
-    is_student = data['employee'] <> 'true'
-    name = data['name']['formatted']
-    email = data['emails'][0]
+    try:
+        token = oauth.Token(request.session['request_token']['oauth_token'], request.session['request_token']['oauth_token_secret'])
+        token.set_verifier(request.GET['oauth_verifier'])
+    except KeyError:
+        # Not coming from the login, start it again
+        return HttpResponseRedirect('/')
 
-    # Get the username and student number
-    resp, content = client.request('https://publicapi.avans.nl/oauth/studentnummer/', 'GET')
-    data = json.loads(content)[0]
-    username = data['inlognaam'].lower()
-    student_number = int(data['studentnummer'])
+    try:
+        access_token = dict(cgi.parse_qsl(api_request(ACCESS_TOKEN_URL, token)))
+        token = oauth.Token(access_token['oauth_token'], access_token['oauth_token_secret'])
+        last_username = request.get_signed_cookie(LAST_USER_COOKIE, None, salt=LAST_USER_SALT)
+        username, name, email, is_student, student_number = get_profile(token, last_username)
+    except (AvansError, KeyError) as e:
+        return login_error(request, e)
 
     user = get_user(username, name, email, is_student, student_number)
 
@@ -59,7 +193,11 @@ def callback(request):
     django_login(request, user)
 
     # Redirect to the main site
-    return HttpResponseRedirect('/')
+    response = HttpResponseRedirect('/')
+    if settings.AVANS_PROFILE_CACHE_TIMEOUT:
+        response.set_signed_cookie(LAST_USER_COOKIE, username, salt=LAST_USER_SALT,
+                                   max_age=settings.AVANS_PROFILE_CACHE_TIMEOUT, httponly=True)
+    return response
 
 def get_user(username, name, email, is_student, student_number):
     # Create or retrieve the corresponding user entry
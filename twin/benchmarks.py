@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+"""
+Timing benchmarks for the heavy parts of TWIN.
+
+These are not picked up by a normal `manage.py test` run because they seed
+large cohorts into the test database. Run them explicitly with:
+
+    python manage.py test twin.benchmarks
+
+Every measurement is printed and kept in `RESULTS` as
+{'benchmark': <string>, 'size': <int>, 'seconds': <float>}.
+
+`run_cohort` times the import, the group making and the JSON APIs on a synthetic
+cohort. To run it at several sizes and save the results as JSON, to compare them
+across commits:
+
+    python manage.py benchmark --sizes 1000,10000 --output results.json
+"""
+
+from django.test import TestCase, SimpleTestCase, LiveServerTestCase, Client, RequestFactory
+from django.conf import settings
+from django.db import connection
+from .models import Student, Preference, PreferenceHistory, Twin, User, bump_students_version
+from .admin import get_difference, sort_by_sheet, get_pairs, array_excel_output
+from . import admin, views
+from .responses import ENCODER, dumps, json_array, json_array_chunks
+import time, random, json, urllib2
+
+RESULTS = []
+
+def record(benchmark, size, seconds):
+    RESULTS.append({'benchmark': benchmark, 'size': size, 'seconds': seconds})
+    print('{0:<40} {1:>8} {2:>10.4f}s'.format(benchmark, size, seconds))
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+def seed_students(count):
+    """
+    Insert `count` students numbered 1..count into the database
+    """
+    Student.objects.bulk_create(
+        [Student(student_number=i, name='Student {0}'.format(i), email='{0}@avans.nl'.format(i))
+         for i in range(1, count + 1)],
+        batch_size=500)
+    # bulk_create sends no signals, so the cached roster of an earlier cohort would be used
+    bump_students_version()
+
+GRAPHS = ('random', 'clustered', 'mutual')
+
+def generate_preferences(count, graph='random', mutual=0.5, seed=1, cluster_size=30):
+    """
+    A preference graph of the students 1..count as a dict {student_number: preference_for}:
+
+    random:    about a `mutual` fraction of the students in reciprocal pairs,
+               most of the others choose a random student
+    clustered: like random, but within groups of `cluster_size` consecutive students,
+               like classmates choosing eachother
+    mutual:    every student in a reciprocal pair
+    """
+    rng = random.Random(seed)
+    if graph == 'mutual':
+        mutual = 1.0
+    size = cluster_size if graph == 'clustered' else count
+
+    preferences = {}
+    for first in range(1, count + 1, size):
+        numbers = list(range(first, min(first + size, count + 1)))
+        rng.shuffle(numbers)
+
+        paired = int(len(numbers) * mutual) // 2 * 2
+        for a, b in zip(numbers[0:paired:2], numbers[1:paired:2]):
+            preferences[a] = b
+            preferences[b] = a
+
+        for a in numbers[paired:]:
+            b = rng.choice(numbers)
+            if a != b:
+                preferences[a] = b
+
+    return preferences
+
+def seed_preferences(count, graph='random', mutual=0.5, seed=1):
+    """
+    Give the students 1..count the preferences of `generate_preferences`.
+    Every preference is also added to the history and every reciprocal pair is a twin.
+    """
+    preferences = generate_preferences(count, graph, mutual, seed)
+
+    Preference.objects.bulk_create(
+        [Preference(student_id=a, preference_for_id=b) for a, b in preferences.items()],
+        batch_size=500)
+    PreferenceHistory.objects.bulk_create(
+        [PreferenceHistory(student_id=a, preference_for_id=b) for a, b in preferences.items()],
+        batch_size=500)
+    Twin.objects.sync()
+
+def percentile(values, p):
+    """
+    The value below which `p` percent of the values are
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def explain(queryset):
+    """
+    The query plan of the queryset as a list of strings
+    """
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(('EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN ') + sql, params)
+        return [' | '.join(unicode(column) for column in row) for row in cursor.fetchall()]
+
+def spreadsheet_students(count, sheets=10):
+    """
+    Spreadsheet students that differ from `seed_students(count)` the way a
+    real import does: a few changed names, a few new students and a few
+    students that are no longer in the list.
+    """
+    students = []
+    for i in range(1, count + 1):
+        if i % 20 == 0:
+            continue # deleted
+        name = 'Student {0}'.format(i) if i % 20 != 1 else 'Renamed {0}'.format(i)
+        students.append({'student_number': i, 'name': name,
+                         'email': '{0}@avans.nl'.format(i), 'sheet': 'IN{0:02d}'.format(i % sheets)})
+
+    for i in range(count + 1, count + count // 20 + 1):
+        students.append({'student_number': i, 'name': 'Student {0}'.format(i),
+                         'email': '', 'sheet': 'IN{0:02d}'.format(i % sheets)})
+    return students
+
+def get_difference_quadratic(all_students):
+    """
+    The original nested-loop get_difference, kept only as a baseline to compare against
+    """
+    twin_students = list(Student.objects.all())
+
+    changed_students = []
+    for student in all_students:
+        student['change'] = 'insert'
+        for twin_student in twin_students:
+            if twin_student.student_number == student['student_number']:
+                if twin_student.name == student['name'] and twin_student.email == student['email']:
+                    student['change'] = 'nothing'
+                else:
+                    student['change'] = 'update'
+                break
+
+        if student['change'] != 'nothing':
+            changed_students.append(student)
+
+    all_student_numbers = [s['student_number'] for s in all_students]
+    deleted_students = [
+        {'student_number': s.student_number, 'name': s.name}
+        for s in twin_students
+        if s.student_number not in all_student_numbers]
+
+    return changed_students, deleted_students
+
+def sort_by_sheet_rescan(students):
+    """
+    The original sort_by_sheet that scans all students once per sheet, kept as a baseline
+    """
+    seen = set()
+    sheets = [s['sheet'] for s in students if not (s['sheet'] in seen or seen.add(s['sheet']))]
+
+    def without_sheet(student):
+        student = dict(student)
+        del student['sheet']
+        return student
+
+    return [{'sheet': sheet, 'students':
+        [without_sheet(s) for s in students if s['sheet'] == sheet]
+    } for sheet in sheets]
+
+class StubGoogleDrive(object):
+    """
+    Stands in for the CachedGoogleDrive of the admin, with one spreadsheet of `students`
+    """
+    def __init__(self, students):
+        self.students = students
+
+    def get_spreadsheets(self):
+        return [{'id': 'benchmark', 'name': 'Benchmark', 'webViewLink': ''}]
+
+    def get_students(self, spreadsheet_id, refresh=False):
+        # Copies, get_difference changes the students
+        return [dict(s) for s in self.students]
+
+def response_content(response):
+    if response.streaming:
+        return b''.join(response.streaming_content)
+    return response.content
+
+def run_cohort(size, graph='clustered', repeat=3):
+    """
+    Seed a cohort of `size` students with a `graph` of preferences, and time the import,
+    the group making and the JSON APIs on it. Every timing is the best of `repeat` runs.
+    """
+    seed_students(size)
+    seed_preferences(size, graph)
+    user = User.objects.create_user(username='benchmark', is_student=True, student=Student.objects.get(student_number=1))
+
+    students = spreadsheet_students(size, sheets=max(1, size // 30))
+    googledrive = StubGoogleDrive(students)
+
+    def best(name, function, *args):
+        record('{0} ({1})'.format(name, graph), size, min(timed(function, *args) for i in range(repeat)))
+
+    def api(view):
+        request = RequestFactory().get('/')
+        request.user = user
+        return response_content(view(request))
+
+    best('get_difference', lambda: get_difference(googledrive.get_students('benchmark')))
+    best('sort_by_sheet', sort_by_sheet, students)
+    best('get_pairs', get_pairs, students)
+    best('array_excel_output', array_excel_output, students, students[0]['sheet'])
+
+    original = admin.googledrive
+    admin.googledrive = googledrive
+    try:
+        best('make_groups', lambda: response_content(admin.make_groups(RequestFactory().get('/'), 'benchmark')))
+    finally:
+        admin.googledrive = original
+
+    best('api_user', api, views.api_user)
+    best('api_preference', api, views.api_preference)
+    best('api_students', api, views.api_students)
+
+    # Everyone but the user, not a roster of an earlier cohort
+    roster = json.loads(api(views.api_students))
+    assert len(roster) == size - 1, 'api_students returned {0} students instead of {1}'.format(len(roster), size - 1)
+
+class CohortBenchmark(TestCase):
+    SIZE = 1000
+
+    def test_random(self):
+        run_cohort(self.SIZE, 'random')
+
+    def test_clustered(self):
+        run_cohort(self.SIZE, 'clustered')
+
+    def test_mutual(self):
+        run_cohort(self.SIZE, 'mutual')
+
+class GetDifferenceBenchmark(TestCase):
+    # The quadratic version takes hours at 100k, so only compare below this size
+    QUADRATIC_LIMIT = 10000
+
+    def run_size(self, size):
+        seed_students(size)
+        students = spreadsheet_students(size)
+
+        record('get_difference', size, timed(get_difference, students))
+        if size <= self.QUADRATIC_LIMIT:
+            record('get_difference (quadratic)', size, timed(get_difference_quadratic, students))
+
+    def test_1k(self):
+        self.run_size(1000)
+
+    def test_10k(self):
+        self.run_size(10000)
+
+    def test_100k(self):
+        self.run_size(100000)
+
+class SortBySheetBenchmark(SimpleTestCase):
+    def test_100_sheets_50k(self):
+        students = spreadsheet_students(50000, sheets=100)
+
+        record('sort_by_sheet (100 sheets)', len(students), timed(sort_by_sheet, students))
+        record('sort_by_sheet (100 sheets, rescan)', len(students), timed(sort_by_sheet_rescan, students))
+        self.assertEquals(sort_by_sheet_rescan(students), sort_by_sheet(students))
+
+class PreferenceIndexBenchmark(TestCase):
+    """
+    Query plans and timings of the lookups on the preference graph
+    """
+    SIZE = 100000
+    REPEAT = 100
+
+    def lookup(self, name, queryset):
+        print(name)
+        for line in explain(queryset):
+            print('    ' + line)
+
+        start = time.time()
+        for i in range(self.REPEAT):
+            list(queryset.all())
+        record(name, self.SIZE, (time.time() - start) / self.REPEAT)
+
+    def test_100k(self):
+        seed_students(self.SIZE)
+        seed_preferences(self.SIZE)
+        student_number = self.SIZE // 2
+
+        self.lookup('who chose a student (api_students)',
+            Preference.objects.filter(preference_for_id=student_number).order_by().values_list('student_id', flat=True))
+        self.lookup('preference with reciprocity (api_preference)',
+            Preference.objects.filter(student_id=student_number).order_by().values_list(
+                'preference_for_id', 'preference_for__name', 'preference_for__preference__preference_for_id'))
+        self.lookup('both students with preferences (save_preference)',
+            Student.objects.filter(student_number__in=[student_number, student_number + 1]).order_by().values_list(
+                'student_number', 'name', 'preference__id', 'preference__preference_for_id'))
+        self.lookup('active twins (get_pairs)',
+            Twin.objects.active().order_by('student1_id').values_list('student1_id', 'student2_id'))
+        self.lookup('history of a student',
+            PreferenceHistory.objects.filter(student_id=student_number).order_by('date'))
+
+        record('get_pairs', self.SIZE, timed(get_pairs, [{'student_number': n} for n in range(1, self.SIZE + 1)]))
+
+
+class RosterJsonBenchmark(SimpleTestCase):
+    """
+    Serializing the roster of /api/students: once into per-student JSON like get_roster,
+    then joined into one array or streamed in chunks, against json.dumps of a list of dicts
+    """
+    SIZE = 50000
+
+    def test_50k(self):
+        roster = [(i, u'Student {0}'.format(i)) for i in range(1, self.SIZE + 1)]
+
+        def dicts():
+            return json.dumps([{'student_number': n, 'name': name} for n, name in roster])
+
+        def serialized():
+            return [dumps({'student_number': n, 'name': name}) for n, name in roster]
+
+        students = serialized()
+
+        record('roster json (list of dicts, stdlib)', self.SIZE, timed(dicts))
+        record('roster json (per student, {0})'.format(ENCODER), self.SIZE, timed(serialized))
+        record('roster json (join serialized)', self.SIZE, timed(json_array, students))
+        record('roster json (stream serialized)', self.SIZE, timed(lambda: list(json_array_chunks(students))))
+
+        self.assertEquals(json.loads(dicts()), json.loads(''.join(json_array_chunks(students))))
+
+class PreferenceLoadBenchmark(LiveServerTestCase):
+    """
+    p50 and p99 latency of /api/preference over HTTP, with a new database connection
+    for every request (CONN_MAX_AGE 0) and with kept connections (CONN_MAX_AGE 60).
+
+    Run it against MySQL, or against SQLite with a TEST NAME in DATABASES so the test
+    database is a file: an in-memory SQLite database is never closed, so both runs are equal.
+    """
+    SIZE = 1000
+    REQUESTS = 500
+
+    def request(self, opener, student_number):
+        if student_number is None:
+            return opener.open(self.live_server_url + '/api/preference').read()
+        return opener.open(self.live_server_url + '/api/preference',
+                           json.dumps({'student_number': student_number})).read()
+
+    def run_requests(self, opener, max_age):
+        # The server opens its connection during the warm up, so it gets this max age
+        connection.settings_dict['CONN_MAX_AGE'] = max_age
+        self.request(opener, None)
+        rng = random.Random(max_age)
+
+        latencies = []
+        for i in range(self.REQUESTS):
+            # Every other request saves a new preference
+            student_number = rng.randint(2, self.SIZE) if i % 2 else None
+            start = time.time()
+            self.request(opener, student_number)
+            latencies.append(time.time() - start)
+
+        record('api_preference p50 (CONN_MAX_AGE={0})'.format(max_age), self.REQUESTS, percentile(latencies, 50))
+        record('api_preference p99 (CONN_MAX_AGE={0})'.format(max_age), self.REQUESTS, percentile(latencies, 99))
+
+    def test_preference(self):
+        seed_students(self.SIZE)
+        seed_preferences(self.SIZE)
+        User.objects.create_user(username='student1', is_student=True, student=Student.objects.get(student_number=1))
+
+        client = Client()
+        client.login(username='student1')
+        opener = urllib2.build_opener()
+        opener.addheaders = [('Cookie', '{0}={1}'.format(
+            settings.SESSION_COOKIE_NAME, client.cookies[settings.SESSION_COOKIE_NAME].value))]
+
+        max_age = connection.settings_dict['CONN_MAX_AGE']
+        try:
+            # Without kept connections first: a connection opened with a max age of 60
+            # would be kept into the next run
+            self.run_requests(opener, 0)
+            self.run_requests(opener, 60)
+        finally:
+            connection.settings_dict['CONN_MAX_AGE'] = max_age
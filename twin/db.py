@@ -0,0 +1,29 @@
+"""
+Health checks for the database connections that are kept open between requests.
+
+With CONN_MAX_AGE a connection is reused by the next request of the same worker thread.
+When MySQL closed it in the meantime, for example after its wait_timeout or a restart,
+that request would fail. For every database with CONN_HEALTH_CHECKS in its settings
+(the name Django itself uses from version 4.1), ConnectionHealthCheckMiddleware pings
+a kept connection before the request can use it, and closes it when it is broken so a
+new one is opened.
+"""
+
+from django.db import connections
+
+
+def close_unusable(database_connections):
+    """
+    Close the open connections with health checks that do not respond, returns how many were closed
+    """
+    closed = 0
+    for connection in database_connections:
+        if connection.settings_dict.get('CONN_HEALTH_CHECKS') \
+                and connection.connection is not None and not connection.is_usable():
+            connection.close()
+            closed += 1
+    return closed
+
+class ConnectionHealthCheckMiddleware(object):
+    def process_request(self, request):
+        close_unusable(connections.all())
@@ -0,0 +1,184 @@
+"""
+Measures what a request costs: the wall time, the number and time of the database
+queries, the number of Google API calls and the size of the response.
+
+InstrumentationMiddleware measures every request when settings.INSTRUMENTATION is on,
+the `instrumented` decorator measures a single view when settings.INSTRUMENTATION_VIEWS is on.
+The measurements are added to the response as a Server-Timing header, so they show up
+in the network panel of the browser, and logged to the 'twin.instrumentation' logger as:
+
+    view=twin.views.api_students method=GET status=200 ms=12.1 queries=2 db_ms=1.3 google_calls=0 bytes=5120
+
+A fraction settings.INSTRUMENTATION_PROFILE_RATE of the measured requests is also run
+under cProfile, the profile is saved in settings.INSTRUMENTATION_PROFILE_DIR when the
+request took longer than settings.INSTRUMENTATION_PROFILE_SLOW seconds.
+
+When instrumentation is off, the middleware and the decorator only check the setting.
+"""
+
+from django.db import connections
+from functools import wraps
+import settings, logging, threading, time, random, cProfile, os
+
+logger = logging.getLogger('twin.instrumentation')
+
+local = threading.local()
+
+class RequestStats(object):
+    def __init__(self, profile=False):
+        self.lock = threading.Lock()
+        self.view = None
+        self.google_calls = 0
+        self.start = time.time()
+
+        # Log the queries of every connection, remember where this request starts
+        self.connections = []
+        for connection in connections.all():
+            if len(connection.queries_log) == connection.queries_log.maxlen:
+                connection.queries_log.clear()
+            self.connections.append((connection, connection.force_debug_cursor, len(connection.queries_log)))
+            connection.force_debug_cursor = True
+
+        self.profile = cProfile.Profile() if profile else None
+        if self.profile is not None:
+            self.profile.enable()
+
+    def stop(self):
+        """
+        Stop measuring and put the connections back the way they were, also when the view failed
+        """
+        self.seconds = time.time() - self.start
+        if self.profile is not None:
+            self.profile.disable()
+
+        self.queries = 0
+        self.query_seconds = 0.0
+        for connection, force_debug_cursor, start in self.connections:
+            queries = list(connection.queries_log)[start:]
+            self.queries += len(queries)
+            self.query_seconds += sum(float(q['time']) for q in queries)
+            connection.force_debug_cursor = force_debug_cursor
+
+    def finish(self, response):
+        self.stop()
+
+        if response.streaming:
+            self.size = int(response['Content-Length']) if response.has_header('Content-Length') else None
+        else:
+            self.size = len(response.content)
+
+    def count_google_call(self):
+        with self.lock:
+            self.google_calls += 1
+
+    def server_timing(self):
+        return 'total;dur={0:.1f}, db;dur={1:.1f};desc="{2} queries", google;desc="{3} calls"'.format(
+            self.seconds * 1000, self.query_seconds * 1000, self.queries, self.google_calls)
+
+    def log_line(self, request, response):
+        return 'view={0} method={1} status={2} ms={3:.1f} queries={4} db_ms={5:.1f} google_calls={6} bytes={7}'.format(
+            self.view or request.path, request.method, response.status_code, self.seconds * 1000,
+            self.queries, self.query_seconds * 1000, self.google_calls, '-' if self.size is None else self.size)
+
+    def save_profile(self):
+        if self.profile is None or self.seconds < settings.INSTRUMENTATION_PROFILE_SLOW:
+            return None
+
+        if not os.path.isdir(settings.INSTRUMENTATION_PROFILE_DIR):
+            os.makedirs(settings.INSTRUMENTATION_PROFILE_DIR)
+        path = os.path.join(settings.INSTRUMENTATION_PROFILE_DIR, '{0}-{1:.0f}ms-{2}.prof'.format(
+            (self.view or 'unknown').replace('/', '_'), self.seconds * 1000, int(self.start * 1000)))
+        self.profile.dump_stats(path)
+        return path
+
+def current():
+    """
+    The RequestStats of the request that is measured in this thread, or None
+    """
+    return getattr(local, 'stats', None)
+
+def count_google_call():
+    stats = current()
+    if stats is not None:
+        stats.count_google_call()
+
+def in_current_request(function):
+    """
+    Wrap `function` so it counts towards the current request when it runs in another thread
+    """
+    stats = current()
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        local.stats = stats
+        try:
+            return function(*args, **kwargs)
+        finally:
+            local.stats = None
+    return wrapper
+
+def start(view=None):
+    local.stats = RequestStats(profile=random.random() < settings.INSTRUMENTATION_PROFILE_RATE)
+    local.stats.view = view
+    return local.stats
+
+def stop(stats):
+    local.stats = None
+    stats.stop()
+
+def finish(stats, request, response):
+    local.stats = None
+    stats.finish(response)
+
+    response['Server-Timing'] = stats.server_timing()
+    logger.info(stats.log_line(request, response))
+
+    path = stats.save_profile()
+    if path is not None:
+        logger.info('Saved the profile of a slow request to {0}'.format(path))
+    return response
+
+def view_name(view):
+    return '{0}.{1}'.format(view.__module__, getattr(view, '__name__', type(view).__name__))
+
+class InstrumentationMiddleware(object):
+    def process_request(self, request):
+        if settings.INSTRUMENTATION:
+            request.twin_stats = start()
+
+    def process_view(self, request, view, view_args, view_kwargs):
+        stats = getattr(request, 'twin_stats', None)
+        if stats is not None:
+            stats.view = view_name(view)
+
+    def process_response(self, request, response):
+        stats = getattr(request, 'twin_stats', None)
+        if stats is None:
+            return response
+        return finish(stats, request, response)
+
+    def process_exception(self, request, exception):
+        # Without a response the response middleware doesn't run
+        stats = getattr(request, 'twin_stats', None)
+        if stats is not None:
+            request.twin_stats = None
+            stop(stats)
+
+def instrumented(view):
+    """
+    Measure a single view when settings.INSTRUMENTATION_VIEWS is on, also when
+    settings.INSTRUMENTATION is off. Does nothing when the middleware already measures the request.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not settings.INSTRUMENTATION_VIEWS or current() is not None:
+            return view(request, *args, **kwargs)
+
+        stats = start(view_name(view))
+        try:
+            response = view(request, *args, **kwargs)
+        except:
+            stop(stats)
+            raise
+        return finish(stats, request, response)
+    return wrapper
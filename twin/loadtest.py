@@ -0,0 +1,161 @@
+"""
+A deadline-night rush against a running TWIN server: many students open the site at the
+same time, look around, and save their preference.
+
+The students are a separate cohort with high student numbers, created in the database the
+server uses and deleted afterwards. They are logged in with sessions written directly into
+the session store instead of the Avans OAuth login, so the Avans API is never touched.
+Run it against a local server, see `manage.py loadtest --help`.
+"""
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY, BACKEND_SESSION_KEY, HASH_SESSION_KEY
+from .models import Student, User, bump_students_version
+from .benchmarks import percentile
+from collections import defaultdict
+from importlib import import_module
+from multiprocessing.pool import ThreadPool
+import json, random, time, threading, urllib2
+
+# Student numbers of the cohort start here, far above real student numbers
+FIRST_STUDENT_NUMBER = 900000000
+
+def create_cohort(size):
+    """
+    Create `size` students with a user each, returns the users
+    """
+    students = [Student(student_number=FIRST_STUDENT_NUMBER + i, name='Loadtest {0}'.format(i),
+                        email='loadtest{0}@avans.nl'.format(i)) for i in range(size)]
+    Student.objects.bulk_create(students, batch_size=500)
+    User.objects.bulk_create([User(username='loadtest{0}'.format(i), is_student=True, student=student)
+                              for i, student in enumerate(students)], batch_size=500)
+    bump_students_version()
+    return list(User.objects.filter(username__startswith='loadtest').select_related('student'))
+
+def delete_cohort(session_keys=()):
+    """
+    Delete the students and users of `create_cohort` with their preferences, and the sessions
+    """
+    SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+    for session_key in session_keys:
+        SessionStore(session_key).delete()
+
+    User.objects.filter(username__startswith='loadtest').delete()
+    Student.objects.filter(student_number__gte=FIRST_STUDENT_NUMBER).delete()
+    bump_students_version()
+
+def login(user):
+    """
+    The key of a new session for `user`, like after the OAuth login
+    """
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[SESSION_KEY] = user.pk
+    session[BACKEND_SESSION_KEY] = 'twin.models.UserBackend'
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    return session.session_key
+
+class Results(object):
+    """
+    The latencies and errors of the requests, by name
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def add(self, name, seconds, error):
+        with self.lock:
+            self.latencies[name].append(seconds)
+            if error:
+                self.errors[name] += 1
+
+    def summary(self, seconds):
+        """
+        A list with a dict of statistics for every request name and one for all of them together
+        """
+        rows = []
+        all_latencies = []
+        for name in sorted(self.latencies):
+            all_latencies.extend(self.latencies[name])
+            rows.append(self.statistics(name, self.latencies[name], self.errors[name], seconds))
+        rows.append(self.statistics('total', all_latencies, sum(self.errors.values()), seconds))
+        return rows
+
+    def statistics(self, name, latencies, errors, seconds):
+        return {
+            'name': name,
+            'requests': len(latencies),
+            'requests_per_second': len(latencies) / seconds if seconds else 0,
+            'error_rate': float(errors) / len(latencies) if latencies else 0,
+            'p50': percentile(latencies, 50) if latencies else None,
+            'p95': percentile(latencies, 95) if latencies else None,
+            'p99': percentile(latencies, 99) if latencies else None,
+        }
+
+class VirtualStudent(object):
+    """
+    One student that opens the site, searches a few times and saves a preference
+    """
+    def __init__(self, url, session_key, student_numbers, results, timeout=30, think=0, seed=None):
+        self.url = url.rstrip('/')
+        self.opener = urllib2.build_opener()
+        self.opener.addheaders = [('Cookie', '{0}={1}'.format(settings.SESSION_COOKIE_NAME, session_key))]
+        self.student_numbers = student_numbers
+        self.results = results
+        self.timeout = timeout
+        self.think = think
+        self.rng = random.Random(seed)
+
+    def request(self, name, path, data=None):
+        request = urllib2.Request(self.url + path, data, {'Content-Type': 'application/json'} if data else {})
+        start = time.time()
+        error = False
+        try:
+            self.opener.open(request, timeout=self.timeout).read()
+        except Exception:
+            error = True
+        self.results.add(name, time.time() - start, error)
+
+        if self.think:
+            time.sleep(self.rng.uniform(0, 2 * self.think))
+
+    def run(self):
+        self.request('GET /', '/')
+        self.request('GET /api/bootstrap', '/api/bootstrap')
+        self.request('GET /api/students', '/api/students')
+        for query in ['l', 'lo', 'loadtest 1']:
+            self.request('GET /api/students/search', '/api/students/search?q=' + urllib2.quote(query))
+        self.request('GET /api/preference', '/api/preference')
+
+        # Save a preference, and some students change their mind
+        for i in range(self.rng.choice([1, 1, 2])):
+            self.request('POST /api/preference', '/api/preference',
+                         json.dumps({'student_number': self.rng.choice(self.student_numbers)}))
+
+def run(url, users, concurrency, think=0, timeout=30, seed=1):
+    """
+    Run the rush with a new cohort of `users` students, at most `concurrency` at the same time.
+    Returns (seconds, Results).
+    """
+    delete_cohort()
+    cohort = create_cohort(users)
+    session_keys = []
+    try:
+        session_keys = [login(user) for user in cohort]
+        student_numbers = [user.student_id for user in cohort]
+        results = Results()
+
+        students = [VirtualStudent(url, session_key, student_numbers, results, timeout, think, seed + i)
+                    for i, session_key in enumerate(session_keys)]
+
+        pool = ThreadPool(concurrency)
+        start = time.time()
+        try:
+            pool.map(lambda student: student.run(), students)
+        finally:
+            pool.close()
+            pool.join()
+        return time.time() - start, results
+    finally:
+        delete_cohort(session_keys)
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from twin.testrunner import TestRunner
+from twin import benchmarks
+import json, datetime
+
+
+class Command(BaseCommand):
+    help = ('Time the import, the group making and the JSON APIs on synthetic cohorts, in a test '
+            'database with the caches in memory, like `manage.py test twin.benchmarks`. '
+            'The Google Drive is stubbed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000',
+                            help='Comma separated cohort sizes (default 1000,10000)')
+        parser.add_argument('--graph', action='append', choices=benchmarks.GRAPHS,
+                            help='Preference graph, can be repeated (default all)')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Keep the best of this many runs of every timing (default 3)')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes should be a comma separated list of numbers')
+        graphs = options['graph'] or list(benchmarks.GRAPHS)
+
+        # Without DEBUG and with the caches of the tests, so the cache of a running server is left alone
+        runner = TestRunner(verbosity=0, interactive=False)
+        runner.setup_test_environment()
+        try:
+            old_config = runner.setup_databases()
+            try:
+                for size in sizes:
+                    for graph in graphs:
+                        # Every cohort starts from an empty database
+                        with transaction.atomic():
+                            benchmarks.run_cohort(size, graph, options['repeat'])
+                            transaction.set_rollback(True)
+                vendor = connection.vendor
+            finally:
+                runner.teardown_databases(old_config)
+        finally:
+            runner.teardown_test_environment()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({
+                    'date': datetime.datetime.now().isoformat(),
+                    'database': vendor,
+                    'repeat': options['repeat'],
+                    'results': benchmarks.RESULTS,
+                }, f, indent=2)
+            self.stdout.write('Results written to {0}'.format(options['output']))
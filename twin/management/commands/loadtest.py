@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from twin import loadtest
+import json
+
+
+class Command(BaseCommand):
+    help = ('Simulate a deadline-night rush of students against a running TWIN server that uses '
+            'the same database. A temporary cohort of students is created and deleted afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000',
+                            help='The server to test (default http://127.0.0.1:8000)')
+        parser.add_argument('--users', type=int, default=500,
+                            help='Number of students that visit the site (default 500)')
+        parser.add_argument('--concurrency', type=int, default=50,
+                            help='Number of students at the same time (default 50)')
+        parser.add_argument('--think', type=float, default=0,
+                            help='Average seconds a student waits between requests (default 0)')
+        parser.add_argument('--timeout', type=float, default=30,
+                            help='Seconds before a request counts as an error (default 30)')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+
+    def handle(self, *args, **options):
+        seconds, results = loadtest.run(options['url'], options['users'], options['concurrency'],
+                                        options['think'], options['timeout'])
+        summary = results.summary(seconds)
+
+        self.stdout.write('{0:<28} {1:>8} {2:>8} {3:>7} {4:>8} {5:>8} {6:>8}'.format(
+            'request', 'count', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for row in summary:
+            self.stdout.write('{0:<28} {1:>8} {2:>8.1f} {3:>6.1f}% {4:>8} {5:>8} {6:>8}'.format(
+                row['name'], row['requests'], row['requests_per_second'], row['error_rate'] * 100,
+                *[milliseconds(row[p]) for p in ('p50', 'p95', 'p99')]))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'url': options['url'], 'users': options['users'], 'concurrency': options['concurrency'],
+                           'seconds': seconds, 'results': summary}, f, indent=2)
+            self.stdout.write('Results written to {0}'.format(options['output']))
+
+def milliseconds(seconds):
+    return '-' if seconds is None else '{0:.1f}'.format(seconds * 1000)
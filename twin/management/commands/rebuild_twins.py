@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from twin.models import Twin
+
+
+class Command(BaseCommand):
+    help = 'Compare the active twins with the reciprocal preferences and fix the differences'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help='Only report the differences, fail if there are any')
+
+    def handle(self, *args, **options):
+        missing, outdated = Twin.objects.sync(commit=not options['verify'])
+
+        for student1, student2 in missing:
+            self.stdout.write('Missing twin: {0} and {1}'.format(student1, student2))
+        for student1, student2 in outdated:
+            self.stdout.write('Outdated twin: {0} and {1}'.format(student1, student2))
+
+        if options['verify'] and (missing or outdated):
+            raise CommandError('{0} missing and {1} outdated twins'.format(len(missing), len(outdated)))
+
+        self.stdout.write('{0} twins started and {1} ended'.format(len(missing), len(outdated))
+                          if not options['verify'] else 'All twins are up to date')
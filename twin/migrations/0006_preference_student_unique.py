@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def remove_duplicate_preferences(apps, schema_editor):
+    """
+    Keep only the newest preference of every student, so student can become unique
+    """
+    Preference = apps.get_model('twin', 'Preference')
+
+    seen = set()
+    duplicates = []
+    for id, student_id in Preference.objects.order_by('-id').values_list('id', 'student_id'):
+        if student_id in seen:
+            duplicates.append(id)
+        seen.add(student_id)
+
+    for i in range(0, len(duplicates), 500):
+        Preference.objects.filter(id__in=duplicates[i:i + 500]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('twin', '0005_student_email'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_preferences, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='preference',
+            name='student',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='twin.Student'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 16:53
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('twin', '0006_preference_student_unique'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='preference',
+            index_together=set([('preference_for', 'student')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='preferencehistory',
+            index_together=set([('student', 'date')]),
+        ),
+    ]
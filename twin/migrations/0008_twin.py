@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 16:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_twins(apps, schema_editor):
+    """
+    Start a twin for every pair of students that have eachother as preference
+    """
+    Preference = apps.get_model('twin', 'Preference')
+    Twin = apps.get_model('twin', 'Twin')
+
+    preferences = dict(Preference.objects.order_by().values_list('student_id', 'preference_for_id'))
+    Twin.objects.bulk_create(
+        [Twin(student1_id=a, student2_id=b) for a, b in sorted(preferences.items()) if a < b and preferences.get(b) == a],
+        batch_size=500)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('twin', '0007_preference_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Twin',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateTimeField(auto_now_add=True)),
+                ('end_date', models.DateTimeField(blank=True, null=True)),
+                ('student1', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='student1', to='twin.Student')),
+                ('student2', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='student2', to='twin.Student')),
+            ],
+            options={
+                'ordering': ['start_date'],
+                'verbose_name': 'Twin',
+                'verbose_name_plural': 'Twins',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='twin',
+            index_together=set([('end_date', 'student1')]),
+        ),
+        migrations.RunPython(create_twins, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,12 @@
 from __future__ import unicode_literals
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
-import datetime
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+import datetime, uuid, settings
 
 """
 UserBackend and UserManager are necessary classes to nicely integrate our
@@ -15,10 +20,18 @@ class UserBackend(object):
             return None
 
     def get_user(self, username):
-        try:
-            return User.objects.get(username=username)
-        except User.DoesNotExist:
-            return None
+        """
+        The user with its student, from the cache when possible
+        """
+        key = user_cache_key(username)
+        user = cache.get(key)
+        if user is None:
+            try:
+                user = User.objects.select_related('student').get(username=username)
+            except User.DoesNotExist:
+                return None
+            cache.set(key, user, settings.USER_CACHE_TIMEOUT)
+        return user
 
 class UserManager(BaseUserManager):
     def create_user(self, username, is_student, student=None):
@@ -83,25 +96,86 @@ class Student(models.Model):
         verbose_name_plural = "Studenten"
         ordering = ["name"]
 
+class TwinManager(models.Manager):
+    def active(self):
+        return self.filter(end_date__isnull=True)
+
+    def start(self, student_number1, student_number2):
+        return self.create(student1_id=min(student_number1, student_number2),
+                           student2_id=max(student_number1, student_number2))
+
+    def end(self, student_number1, student_number2=None):
+        """
+        End the active twin of the two students, or every active twin of the first one
+        """
+        if student_number2 is None:
+            twins = self.active().filter(models.Q(student1_id=student_number1) | models.Q(student2_id=student_number1))
+        else:
+            twins = self.active().filter(student1_id=min(student_number1, student_number2),
+                                         student2_id=max(student_number1, student_number2))
+        return twins.update(end_date=timezone.now())
+
+    def sync(self, commit=True):
+        """
+        Compare the active twins with the reciprocal preferences and, when `commit`, fix the differences.
+        Returns two sorted lists of (student_number1, student_number2):
+        the missing twins and the active twins that should have ended.
+        """
+        preferences = dict(Preference.objects.order_by().values_list('student_id', 'preference_for_id'))
+        reciprocal = set((a, b) for a, b in preferences.items() if a < b and preferences.get(b) == a)
+
+        active = set()
+        outdated_ids = []
+        outdated = []
+        for id, student1, student2 in self.active().order_by('id').values_list('id', 'student1_id', 'student2_id'):
+            if (student1, student2) in reciprocal and (student1, student2) not in active:
+                active.add((student1, student2))
+            else:
+                outdated_ids.append(id)
+                outdated.append((student1, student2))
+
+        missing = sorted(reciprocal - active)
+
+        if commit:
+            with transaction.atomic():
+                for i in range(0, len(outdated_ids), 500):
+                    self.filter(id__in=outdated_ids[i:i + 500]).update(end_date=timezone.now())
+                self.bulk_create([Twin(student1_id=a, student2_id=b) for a, b in missing], batch_size=500)
+
+        return missing, sorted(outdated)
+
 """
 A twin is a match between two students who want to be in the same group next year.
-The order of the students is not important. A twin is created when two students have eachother as preference. A twin can end if one of the students changes it preference, in that case
+The order of the students is not important, `student1` has the lowest student number.
+A twin is created when two students have eachother as preference.
+A twin ends when one of the students changes its preference, then it gets an `end_date`.
 """
-""" TODO: Have a better understanding of how students should be matched to terms
 class Twin(models.Model):
     student1 = models.ForeignKey('Student', related_name='student1')
     student2 = models.ForeignKey('Student', related_name='student2')
 
-    start_date = models.DateField()
-    end_date = models.DateField(null=True)
-"""
+    start_date = models.DateTimeField(auto_now_add=True)
+    end_date = models.DateTimeField(null=True, blank=True)
+
+    objects = TwinManager()
+
+    def __unicode__(self):
+        return u'{0} en {1}'.format(self.student1, self.student2)
+
+    class Meta:
+        verbose_name = "Twin"
+        verbose_name_plural = "Twins"
+        ordering = ["start_date"]
+        # The active twins, in order of student number
+        index_together = [["end_date", "student1"]]
 
 """
 A preference contains which other student is the preferred choice for a particular student.
 A student can choose anyone as a preference, but is only twinned when the preference is reciprocal.
+A student has at most one preference.
 """
 class Preference(models.Model):
-    student = models.ForeignKey('Student')
+    student = models.OneToOneField('Student')
     preference_for = models.ForeignKey('Student', related_name='preference_for', verbose_name='Heeft voorkeur voor')
 
     def __unicode__(self):
@@ -111,6 +185,8 @@ class Preference(models.Model):
         verbose_name = "Voorkeur"
         verbose_name_plural = "Voorkeuren"
         ordering = ["student"]
+        # Looking up who chose a student, and whether that is reciprocal, only needs the index
+        index_together = [["preference_for", "student"]]
 
 class PreferenceHistory(models.Model):
     student = models.ForeignKey('Student')
@@ -124,3 +200,103 @@ class PreferenceHistory(models.Model):
         verbose_name = "Voorkeur geschiedenis"
         verbose_name_plural = "Voorkeuren geschiedenis"
         ordering = ["student"]
+        index_together = [["student", "date"]]
+
+"""
+The version of the list of students, it changes every time a Student is
+saved or deleted so cached copies of the list can be recognised as outdated.
+"""
+STUDENTS_VERSION_KEY = 'twin:students:version'
+
+def current_students_version():
+    version = cache.get(STUDENTS_VERSION_KEY)
+    if version is None:
+        cache.add(STUDENTS_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(STUDENTS_VERSION_KEY)
+    return version
+
+def students_version():
+    """
+    The students version to cache something under, a later change of a student
+    in the same transaction then changes the version again
+    """
+    invalidation = pending_invalidation(create=False)
+    if invalidation is not None:
+        invalidation.version_used = True
+    return current_students_version()
+
+def user_cache_key(username, version=None):
+    """
+    The students version is part of the key, so a changed student is never
+    served from the cache with its user, not even after a bulk import.
+    """
+    return u'twin:user:{0}:{1}'.format(username, version or students_version())
+
+class CacheInvalidation(object):
+    """
+    The changes to the cache after the commit of a transaction: a new students version
+    and forgetting the changed users. There is one for every transaction, however many
+    students and users it changes.
+    """
+    def __init__(self):
+        self.students = False
+        self.version_used = False
+        self.usernames = set()
+
+    def __call__(self):
+        if self.students:
+            new_students_version()
+        if self.usernames:
+            cache.delete_many([user_cache_key(username) for username in self.usernames])
+
+def pending_invalidation(create=True):
+    """
+    The CacheInvalidation of the current transaction, or None outside of a transaction
+    """
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        return None
+
+    # A rolled back savepoint removes the invalidation registered in it, then a new one is made
+    for savepoint_ids, function in connection.run_on_commit:
+        if isinstance(function, CacheInvalidation):
+            return function
+
+    if not create:
+        return None
+    invalidation = CacheInvalidation()
+    transaction.on_commit(invalidation)
+    return invalidation
+
+def new_students_version():
+    cache.set(STUDENTS_VERSION_KEY, uuid.uuid4().hex, None)
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_user(instance, **kwargs):
+    cache.delete(user_cache_key(instance.username, current_students_version()))
+
+    invalidation = pending_invalidation()
+    if invalidation is not None:
+        invalidation.usernames.add(instance.username)
+
+@receiver(post_save, sender=Student)
+@receiver(post_delete, sender=Student)
+def bump_students_version(**kwargs):
+    """
+    Call this after changing students without signals, like bulk_create or update.
+    The version is changed again after the commit, so a list built by another
+    request while the transaction was still running is not kept.
+
+    In a transaction the version is changed right away only when it was used since the
+    last change, and once after the commit. Deleting many students doesn't write the
+    cache for every one of them.
+    """
+    invalidation = pending_invalidation()
+    if invalidation is None:
+        new_students_version()
+    elif not invalidation.students or invalidation.version_used:
+        invalidation.students = True
+        invalidation.version_used = False
+        new_students_version()
+
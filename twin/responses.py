@@ -0,0 +1,74 @@
+"""
+JSON responses for the API views.
+
+`dumps` uses orjson or ujson when one of them is installed and the standard json module
+otherwise. They return a byte string, with non-ASCII characters either escaped or in UTF-8.
+Arrays of already serialized items are streamed in chunks once they are large, so the
+whole array is never one string.
+"""
+
+from django.http import HttpResponse, StreamingHttpResponse
+import json
+
+try:
+    import orjson
+    ENCODER = 'orjson'
+
+    def dumps(value):
+        return orjson.dumps(value)
+except ImportError:
+    try:
+        import ujson
+        ENCODER = 'ujson'
+
+        def dumps(value):
+            return ujson.dumps(value)
+    except ImportError:
+        ENCODER = 'json'
+
+        def dumps(value):
+            return json.dumps(value)
+
+# Arrays with more items than this are streamed, in chunks of this many items
+STREAM_CHUNK_SIZE = 1000
+
+def json_response(value, status=200):
+    return HttpResponse(dumps(value), content_type='application/json', status=status)
+
+def raw_json_response(content, status=200):
+    """
+    A response with JSON that is already serialized
+    """
+    return HttpResponse(content, content_type='application/json', status=status)
+
+def json_array(items):
+    """
+    A JSON array of already serialized items
+    """
+    return '[' + ', '.join(items) + ']'
+
+def json_array_chunks(items, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    The same JSON as `json_array`, as a generator of strings of at most `chunk_size` items
+    """
+    yield '['
+    chunk = []
+    separator = ''
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield separator + ', '.join(chunk)
+            separator = ', '
+            chunk = []
+    if chunk:
+        yield separator + ', '.join(chunk)
+    yield ']'
+
+def json_array_response(items, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    A response with a JSON array of already serialized items, `items` is a list.
+    Large arrays are streamed with a StreamingHttpResponse.
+    """
+    if len(items) <= chunk_size:
+        return raw_json_response(json_array(items))
+    return StreamingHttpResponse(json_array_chunks(items, chunk_size), content_type='application/json')
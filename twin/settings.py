@@ -47,15 +47,111 @@ CONSTANCE_CONFIG = {
         'Niet veranderen tenzij je weet wat je aan het doen bent.'),
 }
 
+# The cache is shared by all worker processes on the server, the students version in it tells
+# each of them when its roster is outdated. With secrets.MEMCACHED, the address of a memcached
+# server like '127.0.0.1:11211', memcached is used (this needs python-memcached). Otherwise the
+# cache is kept in files, which needs nothing besides the disk. A file based cache lists its
+# directory on every set and removes a random third of its entries once it has MAX_ENTRIES.
+# So the sessions get their own directory, and a full cohort logging in can't push the
+# rosters and users out. The tests use caches in memory, see twin/testrunner.py
+MEMCACHED = getattr(secrets, 'MEMCACHED', None)
+
+if MEMCACHED:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': MEMCACHED,
+        },
+        'sessions': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': MEMCACHED,
+            'KEY_PREFIX': 'sessions',
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(BASE_DIR, 'cache'),
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+        'sessions': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(BASE_DIR, 'cache', 'sessions'),
+            'OPTIONS': {'MAX_ENTRIES': 50000},
+        },
+    }
+
+# Sessions are read from the cache, and logged in users are kept in it for this many seconds
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+SESSION_CACHE_ALIAS = 'sessions'
+USER_CACHE_TIMEOUT = 60 * 60
+
+# The students of a Google spreadsheet are cached for this many seconds,
+# for at most this many spreadsheets at the same time
+GOOGLE_DRIVE_CACHE_TIMEOUT = 60 * 60
+GOOGLE_DRIVE_CACHE_ENTRIES = 10
+
+# Fetch the sheets of a spreadsheet with this many parallel requests,
+# 1 fetches all sheets in a single request
+GOOGLE_SHEETS_FETCH_THREADS = 1
+
+# Google API requests are retried this many times on rate limiting and server errors
+GOOGLE_API_RETRIES = 3
+
+# Downloaded Google API discovery documents are kept here
+GOOGLE_DISCOVERY_CACHE_DIR = os.path.join(BASE_DIR, 'google_discovery_cache')
+
 STATIC_URL = '/public/'
 STATIC_ROOT = 'public'
 
+# Students log in with the OAuth API of Avans. Every request to it may take this many seconds,
+# the profile lookups of the logins run in this many threads
+AVANS_API_URL = 'https://publicapi.avans.nl'
+AVANS_API_TIMEOUT = 10
+AVANS_LOGIN_THREADS = 10
+
+# The profile (name and email) of a user is cached for this many seconds, a repeated login
+# from the same browser then only looks up the username and student number. 0 disables it
+AVANS_PROFILE_CACHE_TIMEOUT = 60 * 60
+
+# Measure the time, database queries, Google API calls and response size of every request,
+# see twin/instrumentation.py. Profile this fraction of the measured requests with cProfile,
+# and keep the profiles of requests that take longer than INSTRUMENTATION_PROFILE_SLOW seconds.
+# INSTRUMENTATION_VIEWS only measures the views decorated with twin.instrumentation.instrumented,
+# the student import and making the groups
+INSTRUMENTATION = False
+INSTRUMENTATION_VIEWS = False
+INSTRUMENTATION_PROFILE_RATE = 0
+INSTRUMENTATION_PROFILE_SLOW = 1.0
+INSTRUMENTATION_PROFILE_DIR = os.path.join(BASE_DIR, 'profiles')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'twin.instrumentation': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
+
+# Files in static/ are served from memory by twin.staticfiles, browsers keep
+# their hashed URLs for this many seconds
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+TEST_RUNNER = 'twin.testrunner.TestRunner'
+
 AUTH_USER_MODEL = 'twin.User'
 
 AUTHENTICATION_BACKENDS = ('twin.models.UserBackend',)
 
 MIDDLEWARE_CLASSES = [
+    'twin.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'twin.staticfiles.StaticFilesMiddleware',
+    'twin.db.ConnectionHealthCheckMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -97,6 +193,11 @@ DATABASES = {
         'PASSWORD': secrets.DB_PASSWORD,
         'HOST': '127.0.0.1',
         'PORT': '3306',
+        # Keep the connection of a worker thread open for this many seconds,
+        # 0 opens a new connection for every request
+        'CONN_MAX_AGE': getattr(secrets, 'DB_CONN_MAX_AGE', 60),
+        # Ping a kept connection before a request uses it, see twin/db.py
+        'CONN_HEALTH_CHECKS': getattr(secrets, 'DB_CONN_HEALTH_CHECKS', True),
     }
 }
 
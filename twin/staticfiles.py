@@ -0,0 +1,148 @@
+"""
+Serves the files in static/ from memory, before the session and authentication middleware run.
+
+Every file is read, hashed and compressed once. `static_url` gives the hashed URL of a file,
+like /static/js/twin.0123456789ab.js, which browsers may keep for `settings.STATIC_MAX_AGE`
+seconds because a changed file gets a new URL. The plain URL keeps working, but browsers
+revalidate it with its ETag.
+
+With DEBUG a file is read again when it changes on disk.
+"""
+
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, quote_etag
+import settings, os, re, gzip, hashlib, mimetypes, io
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+PREFIX = '/static/'
+ROOT = os.path.join(settings.BASE_DIR, 'static')
+
+# Files of these types are sent compressed to browsers that accept it
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+
+HASHED = re.compile(r'^(.+)\.([0-9a-f]{12})(\.[^./]+)$')
+
+class StaticFile(object):
+    def __init__(self, path, mtime, content):
+        self.path = path
+        self.mtime = mtime
+        self.content = content
+        self.hash = hashlib.md5(content).hexdigest()[:12]
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+        self.encodings = []
+        if self.content_type.startswith(COMPRESSIBLE):
+            if brotli is not None:
+                self.add_encoding('br', brotli.compress(content))
+            self.add_encoding('gzip', gzip_compress(content))
+
+    def add_encoding(self, encoding, compressed):
+        # Compressing small files can make them larger
+        if len(compressed) < len(self.content):
+            self.encodings.append((encoding, compressed))
+
+    @property
+    def hashed_path(self):
+        name, extension = os.path.splitext(self.path)
+        return u'{0}.{1}{2}'.format(name, self.hash, extension)
+
+def gzip_compress(content):
+    output = io.BytesIO()
+    with gzip.GzipFile(fileobj=output, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(content)
+    return output.getvalue()
+
+"""
+The loaded files by their path relative to static/
+"""
+files = {}
+
+def get_file(path):
+    """
+    The StaticFile of a path relative to static/, or None when there is no such file
+    """
+    full_path = os.path.normpath(os.path.join(ROOT, path))
+    if not full_path.startswith(ROOT + os.sep):
+        return None
+
+    # Paths like js/./twin.js and js//twin.js share the entry of js/twin.js
+    path = os.path.relpath(full_path, ROOT)
+    static_file = files.get(path)
+    if static_file is not None and not settings.DEBUG:
+        return static_file
+
+    try:
+        mtime = os.path.getmtime(full_path)
+        if static_file is not None and static_file.mtime == mtime:
+            return static_file
+
+        with open(full_path, 'rb') as f:
+            static_file = StaticFile(path, mtime, f.read())
+    except (IOError, OSError):
+        return None
+
+    files[path] = static_file
+    return static_file
+
+def static_url(url):
+    """
+    The hashed URL of a URL like /static/js/twin.js, or the URL itself if it is not a static file
+    """
+    static_file = get_file(url[len(PREFIX):]) if url.startswith(PREFIX) else None
+    return PREFIX + static_file.hashed_path if static_file is not None else url
+
+def accepted_encodings(request):
+    return [e.split(';')[0].strip() for e in request.META.get('HTTP_ACCEPT_ENCODING', '').split(',')]
+
+def serve(request, path):
+    """
+    The response for a path relative to static/, or None if there is no such file
+    """
+    immutable = False
+    static_file = get_file(path)
+
+    match = HASHED.match(path)
+    if static_file is None and match:
+        static_file = get_file(match.group(1) + match.group(3))
+        # An old hash is answered with the current file, but not cached for long
+        immutable = static_file is not None and static_file.hash == match.group(2)
+
+    if static_file is None:
+        return None
+
+    etag = quote_etag(static_file.hash)
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+    else:
+        content = static_file.content
+        encoding = None
+        accepted = accepted_encodings(request)
+        for name, compressed in static_file.encodings:
+            if name in accepted:
+                content = compressed
+                encoding = name
+                break
+
+        response = HttpResponse(content if request.method == 'GET' else '', content_type=static_file.content_type)
+        response['Content-Length'] = len(content)
+        if encoding is not None:
+            response['Content-Encoding'] = encoding
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(static_file.mtime)
+    if static_file.encodings:
+        response['Vary'] = 'Accept-Encoding'
+    if immutable:
+        response['Cache-Control'] = 'public, max-age={0}, immutable'.format(settings.STATIC_MAX_AGE)
+    else:
+        response['Cache-Control'] = 'public, max-age=0'
+    return response
+
+class StaticFilesMiddleware(object):
+    def process_request(self, request):
+        if request.method in ('GET', 'HEAD') and request.path_info.startswith(PREFIX):
+            return serve(request, request.path_info[len(PREFIX):])
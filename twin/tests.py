@@ -1,10 +1,21 @@
 # -*- coding: utf-8 -*-
 
-from django.test import TestCase, Client
-from .models import Student, User, Preference
-from .admin import GoogleDrive, get_difference, sort_by_sheet, get_pairs, array_excel_output
+from django.test import TestCase, LiveServerTestCase, Client, RequestFactory
+from django.http import HttpResponse
+from django.conf import settings as django_settings
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command, CommandError
+from .models import Student, User, Preference, PreferenceHistory, Twin
+from .admin import GoogleDrive, CachedGoogleDrive, DiscoveryCache, get_difference, apply_import, sort_by_sheet, group_by_sheet, get_pairs, array_excel_output, excel_output_by_sheet, write_groups_workbook
 from .avans import get_user
-import json
+from .views import api_preference
+from .staticfiles import static_url
+from .responses import json_array_chunks, json_array_response
+from .db import close_unusable
+from . import admin, models, instrumentation, loadtest, avans, views, staticfiles, settings as twin_settings
+import json, io, zipfile, os, shutil, tempfile, gzip, logging, threading, time, BaseHTTPServer, SocketServer
 
 client = Client()
 
@@ -29,12 +40,186 @@ class LoginGetUserTest(TestCase):
         self.assertEquals(2, Student.objects.count())
         self.assertEquals(2, User.objects.count())
 
+class StubAvansServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Answers the requests of the OAuth login like the Avans API, with an optional delay per path.
+    Requests for the paths in `hold` wait until another request is being answered as well.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubAvansHandler)
+        self.connections = 0
+        self.requests = []
+        self.delays = {}
+        self.hold = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.in_flight_changed = threading.Condition()
+        self.responses = {
+            '/oauth/request_token': (200, 'oauth_token=request&oauth_token_secret=secret'),
+            '/oauth/access_token': (200, 'oauth_token=access&oauth_token_secret=secret'),
+            '/oauth/people/@me': (200, json.dumps(
+                {'employee': 'false', 'name': {'formatted': 'Paul Wagener'}, 'emails': ['p.wagener@avans.nl']})),
+            '/oauth/studentnummer/': (200, json.dumps([{'inlognaam': 'PWagener', 'studentnummer': '2'}])),
+        }
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+class StubAvansHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep connections open
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        self.server.requests.append(path)
+
+        with self.server.in_flight_changed:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+            self.server.in_flight_changed.notify_all()
+            if path in self.server.hold and self.server.in_flight < 2:
+                self.server.in_flight_changed.wait(0.5)
+        try:
+            time.sleep(self.server.delays.get(path, 0))
+        finally:
+            with self.server.in_flight_changed:
+                self.server.in_flight -= 1
+
+        status, content = self.server.responses.get(path, (404, ''))
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+class AvansLoginTest(TestCase):
+    def setUp(self):
+        self.server = StubAvansServer()
+        threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.01}).start()
+
+        self.settings = (twin_settings.AVANS_API_URL, twin_settings.AVANS_API_TIMEOUT,
+                         twin_settings.AVANS_PROFILE_CACHE_TIMEOUT)
+        twin_settings.AVANS_API_URL = self.server.url
+        twin_settings.AVANS_API_TIMEOUT = 1
+        cache.clear()
+
+    def tearDown(self):
+        twin_settings.AVANS_API_URL, twin_settings.AVANS_API_TIMEOUT, twin_settings.AVANS_PROFILE_CACHE_TIMEOUT = self.settings
+        # Close the kept-alive connections, so the server threads stop
+        for connection in avans.client.http().connections.values():
+            connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def login(self):
+        response = self.client.get('/admin/login/')
+        self.assertEquals(302, response.status_code)
+        self.assertEquals(self.server.url + '/oauth/saml.php?oauth_token=request', response['Location'])
+
+        return self.client.get('/oauth/callback', {'oauth_verifier': 'verifier'})
+
+    def test_login(self):
+        response = self.login()
+
+        self.assertEquals(302, response.status_code)
+        self.assertEquals({'username': 'pwagener', 'student': {'student_number': 2, 'name': 'Paul Wagener'}},
+                          self.client.get('/api/user').json())
+        self.assertEquals('p.wagener@avans.nl', Student.objects.get(student_number=2).email)
+
+    def test_profile_lookups_concurrent(self):
+        self.server.hold = {'/oauth/people/@me', '/oauth/studentnummer/'}
+
+        self.assertEquals(302, self.login().status_code)
+        self.assertEquals(2, self.server.max_in_flight)
+
+    def test_timeout(self):
+        self.server.delays = {'/oauth/people/@me': 2}
+
+        response = self.login()
+        self.assertEquals(502, response.status_code)
+        self.assertIn('Inloggen is niet gelukt', response.content)
+        self.assertEquals(0, User.objects.count())
+
+    def test_error_status(self):
+        self.server.responses['/oauth/access_token'] = (500, '')
+
+        self.assertEquals(502, self.login().status_code)
+
+    def test_login_unreachable(self):
+        self.server.responses['/oauth/request_token'] = (503, '')
+
+        self.assertEquals(502, self.client.get('/admin/login/').status_code)
+
+    def test_callback_without_login(self):
+        response = Client().get('/oauth/callback', {'oauth_verifier': 'verifier'})
+
+        self.assertEquals(302, response.status_code)
+
+    def profile_lookups(self):
+        return len([path for path in self.server.requests if path in ('/oauth/people/@me', '/oauth/studentnummer/')])
+
+    def test_keep_alive(self):
+        avans.api_request('/oauth/request_token')
+        avans.api_request('/oauth/access_token')
+
+        self.assertEquals(1, self.server.connections)
+
+    def people_lookups(self):
+        return self.server.requests.count('/oauth/people/@me')
+
+    def test_repeated_login_cached(self):
+        self.login()
+        # Avans hands out a new access token for every login
+        self.server.responses['/oauth/access_token'] = (200, 'oauth_token=other&oauth_token_secret=secret')
+        self.assertEquals(302, self.login().status_code)
+
+        self.assertEquals(3, self.profile_lookups())
+        self.assertEquals(1, self.people_lookups())
+        self.assertEquals({'username': 'pwagener', 'student': {'student_number': 2, 'name': 'Paul Wagener'}},
+                          self.client.get('/api/user').json())
+
+    def test_other_user_same_browser(self):
+        self.login()
+        self.server.responses['/oauth/people/@me'] = (200, json.dumps(
+            {'employee': 'false', 'name': {'formatted': 'Bart Gelens'}, 'emails': ['b.gelens@avans.nl']}))
+        self.server.responses['/oauth/studentnummer/'] = (200, json.dumps([{'inlognaam': 'BGelens', 'studentnummer': '3'}]))
+        self.login()
+
+        self.assertEquals(2, self.people_lookups())
+        self.assertEquals({'username': 'bgelens', 'student': {'student_number': 3, 'name': 'Bart Gelens'}},
+                          self.client.get('/api/user').json())
+
+    def test_forged_cookie(self):
+        self.login()
+        self.client = Client()
+        self.client.cookies[avans.LAST_USER_COOKIE] = 'pwagener'
+        self.login()
+
+        self.assertEquals(2, self.people_lookups())
+
+    def test_profile_cache_disabled(self):
+        twin_settings.AVANS_PROFILE_CACHE_TIMEOUT = 0
+        self.login()
+        self.login()
+
+        self.assertEquals(4, self.profile_lookups())
+
 
 """
 Tests the /api/students list that should return a list of all the students
 """
 class ApiStudentsTest(TestCase):
     def setUp(self):
+        cache.clear()
         self.paul = Student.objects.create(student_number=1, name='Paul Wagener')
         self.reinier = Student.objects.create(student_number=2, name='Reinier Dickhout')
         self.bob = Student.objects.create(student_number=3, name=u'Bõb van der PUTTEN') # test unicode
@@ -104,6 +289,176 @@ class ApiStudentsTest(TestCase):
         # Undefined behaviour, but it shouldn't crash
         client.get('/api/students')
 
+    def test_not_modified(self):
+        response = client.get('/api/students')
+        self.assertEqual(304, client.get('/api/students', HTTP_IF_NONE_MATCH=response['ETag']).status_code)
+
+    def test_preferred_us_changes_etag(self):
+        etag = client.get('/api/students')['ETag']
+        Preference.objects.create(student=self.bob, preference_for=self.paul)
+        self.expected[0]['reciprocal'] = True
+
+        response = client.get('/api/students', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.expected, response.json())
+
+    def test_student_changed(self):
+        etag = client.get('/api/students')['ETag']
+        self.reinier.name = 'Reinier van Dickhout'
+        self.reinier.save()
+        self.expected[1]['name'] = 'Reinier van Dickhout'
+
+        response = client.get('/api/students', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.expected, response.json())
+
+    def test_student_imported(self):
+        client.get('/api/students')
+        apply_import([{'student_number': 4, 'name': 'Andre Gehring', 'email': ''}], [])
+        self.expected.insert(0, {'student_number': 4, 'name': 'Andre Gehring'})
+
+        self.assertEqual(self.expected, client.get('/api/students').json())
+
+    def test_version_changed_once_per_transaction(self):
+        new_students_version = models.new_students_version
+        changes = []
+        models.new_students_version = lambda: changes.append(True)
+        try:
+            for i in range(10, 20):
+                student = Student.objects.create(student_number=i, name='Student {0}'.format(i))
+                User.objects.create_user(username='student{0}'.format(i), is_student=True, student=student)
+            client.get('/api/students')
+            del changes[:]
+
+            apply_import([], range(10, 20))
+            self.assertEquals(1, len(changes))
+
+            # A version that was used is changed again
+            client.get('/api/students')
+            self.reinier.save()
+            self.assertEquals(2, len(changes))
+        finally:
+            models.new_students_version = new_students_version
+
+"""
+Tests the /api/students/search url that searches the students by name
+"""
+class ApiStudentsSearchTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.paul = Student.objects.create(student_number=1, name='Paul Wagener')
+        self.reinier = Student.objects.create(student_number=2, name='Reinier Dickhout')
+        self.bob = Student.objects.create(student_number=3, name=u'Bõb van der PUTTEN')
+        self.bart = Student.objects.create(student_number=4, name='Bart Gelens')
+
+        self.user = User.objects.create_user(username='pwagener', is_student=True, student=self.paul)
+        client.login(username=self.user.username)
+
+    def search(self, **params):
+        return client.get('/api/students/search', params).json()
+
+    def test_prefix(self):
+        self.assertEqual([{'student_number': 4, 'name': 'Bart Gelens'}], self.search(q='bar'))
+
+    def test_case_and_accents(self):
+        self.assertEqual([{'student_number': 3, 'name': u'Bõb van der PUTTEN'}], self.search(q=u'BOB'))
+        self.assertEqual([{'student_number': 3, 'name': u'Bõb van der PUTTEN'}], self.search(q=u'bõb van'))
+
+    def test_later_word(self):
+        self.assertEqual([3], [s['student_number'] for s in self.search(q='putt')])
+        self.assertEqual([4, 3], [s['student_number'] for s in self.search(q='b')])
+
+    def test_not_ourselves(self):
+        self.assertEqual([], self.search(q='paul'))
+
+    def test_limit(self):
+        self.assertEqual([4], [s['student_number'] for s in self.search(q='b', limit=1)])
+
+    def test_reciprocal(self):
+        Preference.objects.create(student=self.bob, preference_for=self.paul)
+
+        self.assertEqual([{'student_number': 3, 'name': u'Bõb van der PUTTEN', 'reciprocal': True}], self.search(q='bob'))
+
+    def test_no_query(self):
+        Preference.objects.create(student=self.bob, preference_for=self.paul)
+        Preference.objects.create(student=self.bart, preference_for=self.paul)
+        Preference.objects.create(student=self.reinier, preference_for=self.bart)
+
+        self.assertEqual([
+            {'student_number': 4, 'name': 'Bart Gelens', 'reciprocal': True},
+            {'student_number': 3, 'name': u'Bõb van der PUTTEN', 'reciprocal': True},
+            ], self.search())
+
+    def test_new_student(self):
+        self.search(q='andre')
+        Student.objects.create(student_number=5, name=u'André Gehring')
+
+        self.assertEqual([5], [s['student_number'] for s in self.search(q='andre')])
+
+"""
+Tests the /api/bootstrap url, that combines /api/user, /api/preference and /api/students/search
+"""
+class ApiBootstrapTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.paul = Student.objects.create(student_number=1, name='Paul Wagener')
+        self.bart = Student.objects.create(student_number=2, name='Bart Gelens')
+        self.stijn = Student.objects.create(student_number=3, name='Stijn Smulders')
+        self.user = User.objects.create_user(username='pwagener', is_student=True, student=self.paul)
+
+        client.login(username=self.user.username)
+
+    def test_nothing_chosen(self):
+        expected = {
+            'user': {'username': 'pwagener', 'student': {'student_number': 1, 'name': 'Paul Wagener'}},
+            'preference': None,
+            'students': []
+        }
+        self.assertEqual(expected, client.get('/api/bootstrap').json())
+
+    def test_reciprocal(self):
+        Preference.objects.create(student=self.paul, preference_for=self.bart)
+        Preference.objects.create(student=self.bart, preference_for=self.paul)
+        Preference.objects.create(student=self.stijn, preference_for=self.paul)
+
+        response = client.get('/api/bootstrap').json()
+
+        self.assertEqual({'student_number': 2, 'name': 'Bart Gelens', 'reciprocal': True}, response['preference'])
+        self.assertEqual([
+            {'student_number': 2, 'name': 'Bart Gelens', 'reciprocal': True},
+            {'student_number': 3, 'name': 'Stijn Smulders', 'reciprocal': True},
+        ], response['students'])
+
+    def test_all_who_chose(self):
+        for i in range(10, 22):
+            Preference.objects.create(student=Student.objects.create(student_number=i, name='Student {0}'.format(i)),
+                                      preference_for=self.paul)
+
+        self.assertEqual(12, len(client.get('/api/bootstrap').json()['students']))
+
+    def test_same_as_separate_apis(self):
+        Preference.objects.create(student=self.paul, preference_for=self.stijn)
+        Preference.objects.create(student=self.bart, preference_for=self.paul)
+
+        response = client.get('/api/bootstrap').json()
+
+        self.assertEqual(client.get('/api/user').json(), response['user'])
+        self.assertEqual(client.get('/api/preference').json(), response['preference'])
+        self.assertEqual(client.get('/api/students/search').json(), response['students'])
+
+    def test_teacher(self):
+        teacher = User.objects.create_user(username='teacher', is_student=False)
+        client.login(username=teacher.username)
+
+        self.assertEqual({'user': {'username': 'teacher'}, 'preference': None, 'students': []},
+                         client.get('/api/bootstrap').json())
+
+    def test_single_query(self):
+        client.get('/api/bootstrap')
+
+        with self.assertNumQueries(1):
+            client.get('/api/bootstrap')
+
 """
 Tests the /api/user url, should return information about the current logged in user
 """
@@ -131,6 +486,40 @@ class ApiUserTest(TestCase):
         response = client.get('/api/user')
         self.assertEqual(expected, response.json())
 
+    def test_cached_no_queries(self):
+        client.login(username=self.user_student.username)
+        client.get('/api/user')
+
+        with self.assertNumQueries(0):
+            response = client.get('/api/user')
+        self.assertEqual('Paul Wagener', response.json()['student']['name'])
+
+    def test_student_change(self):
+        client.login(username=self.user_student.username)
+        client.get('/api/user')
+
+        # Like the import, without signals
+        apply_import([{'student_number': 1, 'name': 'Paul W.', 'email': '', 'change': 'update'}], [])
+
+        self.assertEqual('Paul W.', client.get('/api/user').json()['student']['name'])
+
+    def test_user_change(self):
+        client.login(username=self.user_teacher.username)
+        client.get('/api/user')
+
+        self.user_teacher.student = Student.objects.get(student_number=1)
+        self.user_teacher.save()
+
+        self.assertIn('student', client.get('/api/user').json())
+
+    def test_deleted_user(self):
+        client.login(username=self.user_teacher.username)
+        client.get('/api/user')
+
+        self.user_teacher.delete()
+
+        self.assertEqual(302, client.get('/api/user').status_code)
+
 """
 Tests the /api/preference url
 Should return information about the current preference and be able to POST new preference information
@@ -211,6 +600,198 @@ class ApiPreferenceTest(TestCase):
 
         self.assertEquals(0, Preference.objects.all().count())
 
+    def test_post_reciprocal(self):
+        Preference.objects.create(student=self.bart, preference_for=self.paul)
+
+        response = client.post('/api/preference', json.dumps({'student_number': 2}), content_type='application/json')
+
+        expected = {
+            'student_number': 2,
+            'name': 'Bart Gelens',
+            'reciprocal': True
+        }
+        self.assertEqual(expected, response.json())
+
+    def test_post_history(self):
+        client.post('/api/preference', json.dumps({'student_number': 2}), content_type='application/json')
+        client.post('/api/preference', json.dumps({'student_number': 3}), content_type='application/json')
+
+        self.assertEquals([2, 3], list(PreferenceHistory.objects.filter(student=self.paul)
+                                       .order_by('date', 'id').values_list('preference_for_id', flat=True)))
+
+    def test_post_unknown_student(self):
+        Preference.objects.create(student=self.paul, preference_for=self.stijn)
+
+        response = client.post('/api/preference', json.dumps({'student_number': 42}), content_type='application/json')
+
+        self.assertEquals(404, response.status_code)
+        self.assertTrue(Preference.objects.filter(student=self.paul, preference_for=self.stijn).exists())
+
+    def count_queries(self, request):
+        """
+        The number of queries the view runs, without the savepoints the test transaction adds
+        """
+        request.user = User.objects.select_related('student').get(username=self.user.username)
+
+        with CaptureQueriesContext(connection) as queries:
+            api_preference(request)
+        return len([q for q in queries.captured_queries if 'SAVEPOINT' not in q['sql']])
+
+    def post(self, content):
+        return RequestFactory().post('/api/preference', json.dumps(content), content_type='application/json')
+
+    def test_post_queries(self):
+        self.assertEquals(3, self.count_queries(self.post({'student_number': 2})))
+
+        # Changing an existing preference
+        self.assertEquals(3, self.count_queries(self.post({'student_number': 3})))
+
+        # Locking the student, ending the twin and removing the preference
+        self.assertEquals(3, self.count_queries(self.post(None)))
+
+    def test_post_twin_queries(self):
+        Preference.objects.create(student=self.bart, preference_for=self.paul)
+
+        # Starting the twin
+        self.assertEquals(4, self.count_queries(self.post({'student_number': 2})))
+
+        # Ending the twin
+        self.assertEquals(4, self.count_queries(self.post({'student_number': 3})))
+
+    def test_get_queries(self):
+        Preference.objects.create(student=self.paul, preference_for=self.bart)
+
+        self.assertEquals(1, self.count_queries(RequestFactory().get('/api/preference')))
+
+class TwinTest(TestCase):
+    def setUp(self):
+        self.paul = Student.objects.create(student_number=1, name='Paul Wagener')
+        self.bart = Student.objects.create(student_number=2, name='Bart Gelens')
+        self.stijn = Student.objects.create(student_number=3, name='Stijn Smulders')
+        self.user = User.objects.create_user(username='pwagener', is_student=True, student=self.paul)
+
+        client.login(username=self.user.username)
+
+    def post(self, student_number):
+        content = {'student_number': student_number} if student_number else None
+        client.post('/api/preference', json.dumps(content), content_type='application/json')
+
+    def active(self):
+        return list(Twin.objects.active().values_list('student1_id', 'student2_id'))
+
+    def test_reciprocal_preference_starts_twin(self):
+        Preference.objects.create(student=self.bart, preference_for=self.paul)
+        self.post(2)
+
+        self.assertEquals([(1, 2)], self.active())
+
+    def test_one_sided_preference_no_twin(self):
+        self.post(2)
+
+        self.assertEquals([], self.active())
+
+    def test_lowest_student_number_first(self):
+        Preference.objects.create(student=self.paul, preference_for=self.bart)
+        client.login(username=User.objects.create_user(username='bgelens', is_student=True, student=self.bart).username)
+        self.post(1)
+
+        self.assertEquals([(1, 2)], self.active())
+
+    def test_change_ends_twin(self):
+        Preference.objects.create(student=self.bart, preference_for=self.paul)
+        self.post(2)
+        self.post(3)
+
+        self.assertEquals([], self.active())
+        self.assertIsNotNone(Twin.objects.get(student1=self.paul, student2=self.bart).end_date)
+
+    def test_remove_ends_twin(self):
+        Preference.objects.create(student=self.bart, preference_for=self.paul)
+        self.post(2)
+        self.post(None)
+
+        self.assertEquals([], self.active())
+        self.assertEquals(1, Twin.objects.count())
+
+    def test_same_preference_again(self):
+        Preference.objects.create(student=self.bart, preference_for=self.paul)
+        self.post(2)
+        self.post(2)
+
+        self.assertEquals(1, Twin.objects.count())
+        self.assertEquals([(1, 2)], self.active())
+
+    def test_sync(self):
+        Preference.objects.create(student=self.paul, preference_for=self.bart)
+        Preference.objects.create(student=self.bart, preference_for=self.paul)
+        Twin.objects.start(1, 3)
+
+        self.assertEquals(([(1, 2)], [(1, 3)]), Twin.objects.sync(commit=False))
+        self.assertEquals([(1, 3)], self.active())
+
+        Twin.objects.sync()
+        self.assertEquals([(1, 2)], self.active())
+        self.assertEquals(([], []), Twin.objects.sync(commit=False))
+
+    def test_sync_duplicate(self):
+        Preference.objects.create(student=self.paul, preference_for=self.bart)
+        Preference.objects.create(student=self.bart, preference_for=self.paul)
+        Twin.objects.start(1, 2)
+        Twin.objects.start(2, 1)
+
+        self.assertEquals(([], [(1, 2)]), Twin.objects.sync())
+        self.assertEquals([(1, 2)], self.active())
+
+    def interleaved(self, first, other_student_number, other_preference_for):
+        """
+        Run `first`, while a save of another student runs just before `first` gets its locks
+        """
+        lock_students = views.lock_students
+
+        def lock_students_after_other_save(*args):
+            views.lock_students = lock_students
+            views.save_preference(other_student_number, other_preference_for)
+            return lock_students(*args)
+
+        views.lock_students = lock_students_after_other_save
+        try:
+            first()
+        finally:
+            views.lock_students = lock_students
+
+    def test_interleaved_mutual_saves(self):
+        self.interleaved(lambda: views.save_preference(1, 2), 2, 1)
+
+        self.assertEquals([(1, 2)], self.active())
+        self.assertEquals(([], []), Twin.objects.sync(commit=False))
+
+    def test_interleaved_switch(self):
+        # Bart switches from Paul to Stijn while Paul chooses Bart
+        Preference.objects.create(student=self.bart, preference_for=self.paul)
+        self.interleaved(lambda: views.save_preference(1, 2), 2, 3)
+
+        self.assertEquals([], self.active())
+        self.assertEquals(([], []), Twin.objects.sync(commit=False))
+
+    def test_interleaved_remove(self):
+        # Bart chooses Paul while Paul removes his preference for Bart
+        Preference.objects.create(student=self.paul, preference_for=self.bart)
+        self.interleaved(lambda: self.post(None), 2, 1)
+
+        self.assertEquals([], self.active())
+        self.assertEquals(([], []), Twin.objects.sync(commit=False))
+
+    def test_command(self):
+        Preference.objects.create(student=self.paul, preference_for=self.bart)
+        Preference.objects.create(student=self.bart, preference_for=self.paul)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_twins', verify=True, stdout=io.BytesIO())
+
+        call_command('rebuild_twins', stdout=io.BytesIO())
+        call_command('rebuild_twins', verify=True, stdout=io.BytesIO())
+        self.assertEquals([(1, 2)], self.active())
+
 class GoogleDriveTest(TestCase):
 
     @classmethod
@@ -231,6 +812,164 @@ class GoogleDriveTest(TestCase):
              {'sheet': 'SWA13', 'student_number': 2079014, 'name': 'Mark Arnoldussen', 'email': ''}
             ], students)
 
+def load_testdata(name):
+    with open(os.path.join(os.path.dirname(__file__), 'testdata', name)) as f:
+        return json.load(f)
+
+class RecordedSheetsService(object):
+    """
+    Stands in for the Google Sheets API service, answering with responses recorded in twin/testdata
+    """
+    def __init__(self):
+        self.requests = []
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return RecordedValuesService(self)
+
+    def get(self, **kwargs):
+        return self.request('get', kwargs, load_testdata('sheets_get.json'))
+
+    def request(self, method, kwargs, response):
+        self.requests.append((method, kwargs))
+        return RecordedRequest(response)
+
+class RecordedValuesService(object):
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, **kwargs):
+        titles = [s['properties']['title'] for s in load_testdata('sheets_get.json')['sheets']]
+        value_range = load_testdata('sheets_values_batchget.json')['valueRanges'][titles.index(kwargs['range'].split("'")[1])]
+        return self.service.request('values.get', kwargs, value_range)
+
+    def batchGet(self, **kwargs):
+        return self.service.request('batchGet', kwargs, load_testdata('sheets_values_batchget.json'))
+
+class RecordedRequest(object):
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self, http=None, num_retries=0):
+        return self.response
+
+class GoogleDriveRecordedTest(TestCase):
+    def setUp(self):
+        self.googledrive = GoogleDrive(sheets=RecordedSheetsService())
+
+    def test_get_students(self):
+        students = self.googledrive.get_students('1VSPpEuiSAfmAEhzpR11T6qRr6Dm32HWx3k9fW1hlSJw')
+        self.assertEquals(
+            [{'sheet': 'IN01', 'student_number': 2097174, 'name': u'Jorrit Aärts', 'email': 'gjrm.aarts@student.avans.nl'},
+             {'sheet': 'IN01', 'student_number': 2113371, 'name': 'Rob van den Akker', 'email': 'rma.vandenakker@student.avans.nl'},
+             {'sheet': 'IN01', 'student_number': 2098472, 'name': 'Quirijn Akkermans', 'email': 'qb.akkermans@student.avans.nl'},
+             {'sheet': 'SWA13', 'student_number': 2077073, 'name': 'Bert Alderliesten', 'email': ''},
+             {'sheet': 'SWA13', 'student_number': 2079014, 'name': 'Mark Arnoldussen', 'email': ''}
+            ], students)
+
+    def test_requests(self):
+        self.googledrive.get_students('abc')
+
+        self.assertEquals(['get', 'batchGet'], [method for method, kwargs in self.googledrive.sheets.requests])
+        self.assertNotIn('includeGridData', self.googledrive.sheets.requests[0][1])
+        self.assertEquals(["'IN01'!A2:E", "'SWA13'!A2:E", "'Leeg'!A2:E"], self.googledrive.sheets.requests[1][1]['ranges'])
+
+    def test_get_students_parallel(self):
+        students = GoogleDrive(sheets=RecordedSheetsService()).get_students('abc')
+
+        googledrive = GoogleDrive(sheets=RecordedSheetsService(), threads=4)
+        self.assertEquals(students, googledrive.get_students('abc'))
+        self.assertEquals(['get', 'values.get', 'values.get', 'values.get'],
+                          sorted(method for method, kwargs in googledrive.sheets.requests))
+
+class GoogleDriveLazyTest(TestCase):
+    def test_nothing_loaded(self):
+        googledrive = GoogleDrive()
+        self.assertIsNone(googledrive.drive_service)
+        self.assertIsNone(googledrive.sheets_service)
+
+class DiscoveryCacheTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_set(self):
+        cache = DiscoveryCache(os.path.join(self.directory, 'discovery'))
+        self.assertIsNone(cache.get('https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'))
+
+        cache.set('https://www.googleapis.com/discovery/v1/apis/drive/v3/rest', '{"name": "drive"}')
+        self.assertEquals('{"name": "drive"}', cache.get('https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'))
+        self.assertIsNone(cache.get('https://www.googleapis.com/discovery/v1/apis/sheets/v4/rest'))
+
+    def test_expired(self):
+        cache = DiscoveryCache(self.directory, max_age=-1)
+        cache.set('https://www.googleapis.com/discovery/v1/apis/drive/v3/rest', '{"name": "drive"}')
+        self.assertIsNone(cache.get('https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'))
+
+class FakeGoogleDrive(object):
+    def __init__(self):
+        self.modified_time = '2016-11-01T12:00:00.000Z'
+        self.fetches = 0
+
+    def get_modified_time(self, spreadsheet_id):
+        return self.modified_time
+
+    def get_students(self, spreadsheet_id):
+        self.fetches += 1
+        return [{'sheet': 'IN01', 'student_number': 1, 'name': spreadsheet_id, 'email': ''}]
+
+class CachedGoogleDriveTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.drive = FakeGoogleDrive()
+        self.googledrive = CachedGoogleDrive(self.drive, timeout=60, max_entries=2)
+
+    def test_cached(self):
+        students = self.googledrive.get_students('a')
+        self.assertEquals(students, self.googledrive.get_students('a'))
+        self.assertEquals(1, self.drive.fetches)
+
+    def test_modified(self):
+        self.googledrive.get_students('a')
+        self.drive.modified_time = '2016-11-02T12:00:00.000Z'
+        self.googledrive.get_students('a')
+        self.assertEquals(2, self.drive.fetches)
+
+    def test_refresh(self):
+        self.googledrive.get_students('a')
+        self.googledrive.get_students('a', refresh=True)
+        self.assertEquals(2, self.drive.fetches)
+
+    def test_import_after_refresh(self):
+        original = admin.googledrive
+        admin.googledrive = self.googledrive
+        try:
+            client.login(username=User.objects.create_user(username='teacher', is_student=False).username)
+            response = client.get('/admin/twin/student/import/a?refresh')
+            self.assertIn('action="/admin/twin/student/import/a"', response.content)
+
+            # Confirming the import uses the students that were just fetched
+            client.post('/admin/twin/student/import/a', {})
+            self.assertEquals(1, self.drive.fetches)
+        finally:
+            admin.googledrive = original
+
+    def test_least_recently_used_evicted(self):
+        self.googledrive.get_students('a')
+        self.googledrive.get_students('b')
+        self.googledrive.get_students('a')
+        self.googledrive.get_students('c') # evicts b
+        self.assertEquals(3, self.drive.fetches)
+
+        self.googledrive.get_students('a')
+        self.assertEquals(3, self.drive.fetches)
+        self.googledrive.get_students('b')
+        self.assertEquals(4, self.drive.fetches)
+
 class GetDifferenceTest(TestCase):
 
     def setUp(self):
@@ -285,6 +1024,60 @@ class GetDifferenceTest(TestCase):
             'name': 'Bob van der Putten'
             }], deleted)
 
+    def test_insert(self):
+        self.students.append({'student_number': 5, 'name': 'Stijn Smulders', 'sheet': 'IN01', 'email': ''})
+        changed, deleted = get_difference(self.students)
+
+        self.assertEquals([{
+            'student_number': 5,
+            'name': 'Stijn Smulders',
+            'sheet': 'IN01',
+            'change': 'insert',
+            'email': '',
+            }], changed)
+        self.assertEquals([], deleted)
+
+    def test_delete_ordered_by_name(self):
+        changed, deleted = get_difference([])
+
+        self.assertEquals(
+            ['Bart Gelens', 'Bob van der Putten', 'Paul Wagener'],
+            [s['name'] for s in deleted])
+
+
+class ApplyImportTest(TestCase):
+
+    def setUp(self):
+        Student.objects.create(student_number=1, name='Paul Wagener')
+        Student.objects.create(student_number=2, name='Bart Gelens')
+        Student.objects.create(student_number=4, name='Bob van der Putten', email='bob@avans.nl')
+
+    def test_apply(self):
+        counts = apply_import([
+            {'student_number': 1, 'name': 'Paul Wagener', 'email': ''},
+            {'student_number': 2, 'name': 'Bart Gelens', 'email': 'b.gelens@avans.nl'},
+            {'student_number': 3, 'name': u'Stijn Smülders', 'email': ''},
+        ], [4])
+
+        self.assertEquals({'insert': 1, 'update': 1, 'delete': 1}, counts)
+        self.assertEquals(
+            [(2, 'Bart Gelens', 'b.gelens@avans.nl'), (1, 'Paul Wagener', ''), (3, u'Stijn Smülders', '')],
+            list(Student.objects.values_list('student_number', 'name', 'email')))
+
+    def test_chunks(self):
+        counts = apply_import(
+            [{'student_number': n, 'name': 'Student {0}'.format(n), 'email': ''} for n in range(1, 8)],
+            [4], batch_size=2)
+
+        self.assertEquals({'insert': 4, 'update': 3, 'delete': 1}, counts)
+        self.assertEquals(6, Student.objects.count())
+        self.assertEquals('Student 2', Student.objects.get(student_number=2).name)
+
+    def test_unknown_delete(self):
+        counts = apply_import([], [42])
+
+        self.assertEquals({'insert': 0, 'update': 0, 'delete': 0}, counts)
+        self.assertEquals(3, Student.objects.count())
 
 class SortBySheetTest(TestCase):
     def test_sort_by_sheet(self):
@@ -303,6 +1096,14 @@ class SortBySheetTest(TestCase):
                 ]}
             ])
 
+class GroupBySheetTest(TestCase):
+    def test_group_by_sheet(self):
+        paul = {'student_number': 1, 'name': 'Paul Wagener', 'sheet': 'IN02'}
+        bart = {'student_number': 2, 'name': 'Bart Gelens', 'sheet': 'IN01'}
+        stijn = {'student_number': 3, 'name': 'Stijn Smulders', 'sheet': 'IN02'}
+
+        self.assertEquals([('IN02', [paul, stijn]), ('IN01', [bart])], group_by_sheet([paul, bart, stijn]))
+
 class GetPairsTest(TestCase):
     def setUp(self):
         s1 = Student.objects.create(student_number=1, name='Paul Wagener')
@@ -316,6 +1117,7 @@ class GetPairsTest(TestCase):
         self.p2a = Preference.objects.create(student=s3, preference_for=s4)
         self.p2b = Preference.objects.create(student=s4, preference_for=s3)
         self.p3 = Preference.objects.create(student=s5, preference_for=s1)
+        Twin.objects.sync()
 
         self.j1 = {'student_number': 1, 'name': 'Paul Wagener'}
         self.j2 = {'student_number': 2, 'name': 'Bart Gelens'}
@@ -323,19 +1125,33 @@ class GetPairsTest(TestCase):
         self.j4 = {'student_number': 4, 'name': 'Bob van der Putten'}
         self.j5 = {'student_number': 5, 'name': 'Andre Gehring'}
 
+        self.pair1 = ((1, 'Paul Wagener', ''), (2, 'Bart Gelens', ''))
+        self.pair2 = ((3, 'Reinier Dickhout', ''), (4, 'Bob van der Putten', ''))
+
 
     def test_simple_pair(self):
         pairs = get_pairs([self.j1, self.j2])
 
         self.assertEquals(1, len(pairs))
-        self.assertEquals(self.p1a, pairs[0])
+        self.assertEquals(self.pair1, pairs[0])
 
     def test_multiple_pairs(self):
         pairs = get_pairs([self.j1, self.j2, self.j3, self.j4])
 
         self.assertEquals(2, len(pairs))
-        self.assertEquals(self.p1a, pairs[0])
-        self.assertEquals(self.p2a, pairs[1])
+        self.assertEquals(self.pair1, pairs[0])
+        self.assertEquals(self.pair2, pairs[1])
+
+    def test_pair_fields(self):
+        pair = get_pairs([self.j1, self.j2])[0]
+
+        self.assertEquals(1, pair.student.student_number)
+        self.assertEquals('Bart Gelens', pair.preference_for.name)
+        self.assertEquals('', pair.preference_for.email)
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            get_pairs([self.j1, self.j2, self.j3, self.j4, self.j5])
 
     def test_pairs_not_in_given_students(self):
         pairs = get_pairs([self.j1, self.j3, self.j5])
@@ -370,6 +1186,7 @@ class ArrayExcelOutputTest(TestCase):
         s7 = Student.objects.create(student_number=7, name='Han van Osch')
         Preference.objects.create(student=s6, preference_for=s7)
         Preference.objects.create(student=s7, preference_for=s6)
+        Twin.objects.sync()
 
     def test_normal(self):
 
@@ -392,3 +1209,271 @@ class ArrayExcelOutputTest(TestCase):
                 ['1b', 4, 'Bob van der Putten', '', 'SWA13', 'mismatch'],
             ], output)
 
+    def test_mismatch_email(self):
+        Student.objects.filter(student_number=3).update(email='r.dickhout@avans.nl')
+
+        output = array_excel_output(self.students, 'SWA13')
+        self.assertEquals('r.dickhout@avans.nl', output[0][3])
+
+    def test_all_sheets(self):
+        with self.assertNumQueries(1):
+            output = [(sheet, list(rows)) for sheet, rows in excel_output_by_sheet(self.students)]
+
+        self.assertEquals(['IN01', 'SWA13', 'Zwervers'], [sheet for sheet, rows in output])
+        self.assertEquals(array_excel_output(self.students, 'IN01'), output[0][1])
+        self.assertEquals(array_excel_output(self.students, 'SWA13'), output[1][1])
+        self.assertEquals([['1', 6, 'Andre Gehring', '', 'Zwervers', 'single']], output[2][1])
+
+class WriteGroupsWorkbookTest(TestCase):
+    def test_workbook(self):
+        students = [
+            {'student_number': 1, 'name': 'Paul Wagener', 'email': '', 'sheet': 'IN01'},
+            {'student_number': 2, 'name': 'Bart Gelens', 'email': '', 'sheet': 'IN-02'},
+        ]
+
+        output = io.BytesIO()
+        write_groups_workbook(students, output)
+
+        workbook = zipfile.ZipFile(output)
+        self.assertIn('xl/worksheets/sheet2.xml', workbook.namelist())
+        self.assertIn('name="IN02"', workbook.read('xl/workbook.xml'))
+        self.assertIn('Bart Gelens', workbook.read('xl/worksheets/sheet2.xml'))
+
+class StaticFilesTest(TestCase):
+    def test_plain(self):
+        response = client.get('/static/js/twin.js')
+
+        self.assertEquals(200, response.status_code)
+        self.assertIn('javascript', response['Content-Type'])
+        self.assertEquals('public, max-age=0', response['Cache-Control'])
+        self.assertIn('TwinController', response.content)
+        self.assertNumQueries(0, lambda: client.get('/static/js/twin.js'))
+
+    def test_hashed(self):
+        url = static_url('/static/js/twin.js')
+        self.assertRegexpMatches(url, r'^/static/js/twin\.[0-9a-f]{12}\.js$')
+
+        response = client.get(url)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEquals(client.get('/static/js/twin.js').content, response.content)
+
+    def test_old_hash(self):
+        response = client.get('/static/js/twin.000000000000.js')
+
+        self.assertEquals(200, response.status_code)
+        self.assertEquals('public, max-age=0', response['Cache-Control'])
+
+    def test_gzip(self):
+        response = client.get('/static/js/angular.min.js', HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+        self.assertEquals('gzip', response['Content-Encoding'])
+        self.assertEquals('Accept-Encoding', response['Vary'])
+        self.assertEquals(client.get('/static/js/angular.min.js').content,
+                          gzip.GzipFile(fileobj=io.BytesIO(response.content)).read())
+
+    def test_not_modified(self):
+        etag = client.get('/static/css/style.css')['ETag']
+
+        self.assertEquals(304, client.get('/static/css/style.css', HTTP_IF_NONE_MATCH=etag).status_code)
+
+    def test_not_found(self):
+        self.assertEquals(404, client.get('/static/js/missing.js').status_code)
+        self.assertEquals(404, client.get('/static/../twin/settings.py').status_code)
+
+    def test_unnormalized_paths(self):
+        for path in ['js/twin.js', 'js/./twin.js', 'js//twin.js', 'css/../js/twin.js']:
+            self.assertIn('TwinController', client.get('/static/' + path).content)
+
+        self.assertEquals(['js/twin.js'], [path for path in staticfiles.files if path.endswith('twin.js')])
+
+    def test_index_hashed_urls(self):
+        student = Student.objects.create(student_number=1, name='Paul Wagener')
+        client.login(username=User.objects.create_user(username='pwagener', is_student=True, student=student).username)
+
+        content = client.get('/').content
+        self.assertIn(str(static_url('/static/js/twin.js')), content)
+        self.assertNotIn('"/static/js/twin.js"', content)
+
+class ResponsesTest(TestCase):
+    def test_chunks(self):
+        items = [json.dumps({'student_number': i}) for i in range(7)]
+
+        self.assertEquals(['[', items[0] + ', ' + items[1] + ', ' + items[2], ', ' + ', '.join(items[3:6]), ', ' + items[6], ']'],
+                          list(json_array_chunks(items, 3)))
+        self.assertEquals(json.loads('[' + ', '.join(items) + ']'), json.loads(''.join(json_array_chunks(items, 3))))
+
+    def test_empty(self):
+        self.assertEquals('[]', ''.join(json_array_chunks([], 3)))
+
+    def test_streamed_when_large(self):
+        self.assertFalse(json_array_response(['1', '2'], 2).streaming)
+
+        response = json_array_response(['1', '2', '3'], 2)
+        self.assertTrue(response.streaming)
+        self.assertEquals([1, 2, 3], json.loads(''.join(response.streaming_content)))
+
+class FakeConnection(object):
+    def __init__(self, usable, open=True, health_checks=True):
+        self.settings_dict = {'CONN_HEALTH_CHECKS': health_checks}
+        self.connection = object() if open else None
+        self.usable = usable
+        self.closed = False
+
+    def is_usable(self):
+        return self.usable
+
+    def close(self):
+        self.closed = True
+
+class CloseUnusableTest(TestCase):
+    def test_close_unusable(self):
+        broken = FakeConnection(usable=False)
+        working = FakeConnection(usable=True)
+
+        self.assertEquals(1, close_unusable([broken, working]))
+        self.assertTrue(broken.closed)
+        self.assertFalse(working.closed)
+
+    def test_not_open_or_no_health_checks(self):
+        not_open = FakeConnection(usable=False, open=False)
+        no_checks = FakeConnection(usable=False, health_checks=False)
+
+        self.assertEquals(0, close_unusable([not_open, no_checks]))
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.settings = dict((name, getattr(twin_settings, name)) for name in
+                             ['INSTRUMENTATION', 'INSTRUMENTATION_VIEWS', 'INSTRUMENTATION_PROFILE_RATE', 'INSTRUMENTATION_PROFILE_SLOW',
+                              'INSTRUMENTATION_PROFILE_DIR'])
+        twin_settings.INSTRUMENTATION = True
+
+        self.log = ListHandler()
+        instrumentation.logger.addHandler(self.log)
+
+        student = Student.objects.create(student_number=1, name='Paul Wagener')
+        client.login(username=User.objects.create_user(username='pwagener', is_student=True, student=student).username)
+
+    def tearDown(self):
+        instrumentation.logger.removeHandler(self.log)
+        for name, value in self.settings.items():
+            setattr(twin_settings, name, value)
+
+    def test_server_timing(self):
+        response = client.get('/api/preference')
+
+        self.assertRegexpMatches(response['Server-Timing'],
+                                 r'^total;dur=[0-9.]+, db;dur=[0-9.]+;desc="[0-9]+ queries", google;desc="0 calls"$')
+
+    def test_log_line(self):
+        # The user is cached by the first request
+        client.get('/api/preference')
+        response = client.get('/api/preference')
+
+        self.assertEquals(2, len(self.log.messages))
+        self.assertRegexpMatches(self.log.messages[1],
+            r'^view=twin.views.api_preference method=GET status=200 ms=[0-9.]+ queries=1 db_ms=[0-9.]+ '
+            r'google_calls=0 bytes={0}$'.format(len(response.content)))
+
+    def test_disabled(self):
+        twin_settings.INSTRUMENTATION = False
+
+        self.assertFalse(client.get('/api/preference').has_header('Server-Timing'))
+        self.assertEquals([], self.log.messages)
+
+    def test_google_calls(self):
+        stats = instrumentation.start()
+        GoogleDrive(sheets=RecordedSheetsService()).get_students('abc')
+        GoogleDrive(sheets=RecordedSheetsService(), threads=4).get_students('abc')
+        instrumentation.finish(stats, RequestFactory().get('/'), HttpResponse())
+
+        self.assertEquals(6, stats.google_calls)
+
+    def test_decorator(self):
+        twin_settings.INSTRUMENTATION = False
+        twin_settings.INSTRUMENTATION_VIEWS = True
+
+        @instrumentation.instrumented
+        def view(request):
+            Student.objects.count()
+            return HttpResponse('12345')
+
+        response = view(RequestFactory().get('/'))
+
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+        self.assertIn('bytes=5', self.log.messages[0])
+
+    def test_decorator_disabled(self):
+        twin_settings.INSTRUMENTATION = False
+
+        @instrumentation.instrumented
+        def view(request):
+            return HttpResponse('12345')
+
+        self.assertFalse(view(RequestFactory().get('/')).has_header('Server-Timing'))
+        self.assertEquals([], self.log.messages)
+
+    def test_decorator_exception(self):
+        twin_settings.INSTRUMENTATION = False
+        twin_settings.INSTRUMENTATION_VIEWS = True
+        twin_settings.INSTRUMENTATION_PROFILE_RATE = 1
+
+        @instrumentation.instrumented
+        def view(request):
+            self.assertTrue(connection.force_debug_cursor)
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            view(RequestFactory().get('/'))
+
+        self.assertIsNone(instrumentation.current())
+        self.assertFalse(connection.force_debug_cursor)
+
+    def test_middleware_exception(self):
+        middleware = instrumentation.InstrumentationMiddleware()
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        middleware.process_exception(request, ValueError())
+
+        self.assertIsNone(instrumentation.current())
+        self.assertFalse(connection.force_debug_cursor)
+
+    def test_profile(self):
+        twin_settings.INSTRUMENTATION_PROFILE_RATE = 1
+        twin_settings.INSTRUMENTATION_PROFILE_SLOW = 0
+        twin_settings.INSTRUMENTATION_PROFILE_DIR = tempfile.mkdtemp()
+        try:
+            client.get('/api/preference')
+            self.assertEquals(1, len(os.listdir(twin_settings.INSTRUMENTATION_PROFILE_DIR)))
+        finally:
+            shutil.rmtree(twin_settings.INSTRUMENTATION_PROFILE_DIR)
+
+class LoadTestTest(LiveServerTestCase):
+    def test_stub_login(self):
+        user = loadtest.create_cohort(1)[0]
+        client.cookies[django_settings.SESSION_COOKIE_NAME] = loadtest.login(user)
+
+        self.assertEqual('loadtest0', client.get('/api/user').json()['username'])
+
+    def test_run(self):
+        Student.objects.create(student_number=1, name='Paul Wagener')
+
+        seconds, results = loadtest.run(self.live_server_url, users=4, concurrency=2)
+        summary = dict((row['name'], row) for row in results.summary(seconds))
+
+        self.assertEquals(0, summary['total']['error_rate'])
+        self.assertEquals(4, summary['GET /api/bootstrap']['requests'])
+        self.assertEquals(12, summary['GET /api/students/search']['requests'])
+        self.assertGreaterEqual(summary['POST /api/preference']['requests'], 4)
+
+        # Only the cohort is removed
+        self.assertEquals([1], list(Student.objects.values_list('student_number', flat=True)))
+        self.assertEquals(0, User.objects.count())
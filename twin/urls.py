@@ -1,5 +1,4 @@
 from django.conf.urls import url, include
-from django.conf.urls.static import static
 from django.views.static import serve
 from twin import views, avans
 
@@ -11,10 +10,12 @@ admin.autodiscover()
 urlpatterns = [
     url(r'^$', views.home),
     url(r'^logout$', views.logout),
+    url(r'^api/bootstrap$', views.api_bootstrap),
     url(r'^api/user$', views.api_user),
     url(r'^api/preference$', views.api_preference),
     url(r'^api/students$', views.api_students),
+    url(r'^api/students/search$', views.api_students_search),
     url(r'^oauth/callback$', avans.callback),
     url(r'^admin/login/', avans.login),
     url(r'^admin/', admin.site.urls),
-] + static('/static', document_root='static')
+]
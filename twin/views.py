@@ -2,18 +2,45 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth import get_user_model, authenticate, login, logout as django_logout
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse, HttpResponse, HttpResponseRedirect
+from django.http import JsonResponse, HttpResponse, HttpResponseRedirect, HttpResponseNotModified
 from django.core import serializers
+from django.db.models import Q
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.http import quote_etag
 import oauth2 as oauth
-import cgi, json, settings, secrets, avans
-from models import Preference, PreferenceHistory, Student
+import cgi, json, settings, secrets, avans, hashlib, unicodedata, bisect, os, re
+from staticfiles import static_url
+from responses import dumps, json_response, raw_json_response, json_array, json_array_response
+from models import Preference, PreferenceHistory, Student, Twin, students_version
 User = get_user_model()
 
 def home(request):
     if not request.user.is_authenticated():
         return avans.login(request)
     else:
-        return HttpResponse(open(settings.BASE_DIR + '/static/index.html').read())
+        return HttpResponse(get_index_html())
+
+"""
+index.html as (<modification time>, <contents>) with the hashed URLs of its static files.
+It is read once, with DEBUG it is read again when it changes.
+"""
+index_html = (None, None)
+
+def get_index_html():
+    global index_html
+
+    if index_html[1] is None or settings.DEBUG:
+        path = os.path.join(settings.BASE_DIR, 'static', 'index.html')
+        mtime = os.path.getmtime(path)
+        if mtime != index_html[0]:
+            with open(path) as f:
+                contents = re.sub(r'(src|href)="(/static/[^"]+)"',
+                                  lambda m: u'{0}="{1}"'.format(m.group(1), static_url(m.group(2))),
+                                  f.read().decode('utf-8'))
+            index_html = (mtime, contents)
+
+    return index_html[1]
 
 def logout(request):
     django_logout(request)
@@ -21,14 +48,17 @@ def logout(request):
 
 @login_required
 def api_user(request):
-    user = {'username': request.user.username}
+    return json_response(user_json(request.user))
 
-    if request.user.student <> None:
-            user['student'] = {
-                'student_number': request.user.student.student_number,
-                'name': request.user.student.name
+def user_json(user):
+    result = {'username': user.username}
+
+    if user.student <> None:
+            result['student'] = {
+                'student_number': user.student.student_number,
+                'name': user.student.name
             }
-    return HttpResponse(json.dumps(user), content_type='application/json')
+    return result
 
 """
 GET:  Returns which other student the (student)user has as preference.
@@ -45,74 +75,292 @@ POST: Allows a student to set a new preference, the request body has to have the
           'student_number': <student number>
       }
       or `null`
-      It returns the new preference as described in GET in the response
+      It returns the new preference as described in GET in the response,
+      or a 404 when there is no student with that student number
 """
 @login_required
 @csrf_exempt
 def api_preference(request):
     # For teachers this API has undefined behaviour, simply return null
-    if not request.user.student:
-        return HttpResponse(json.dumps(None), content_type='application/json')
+    if not request.user.student_id:
+        return json_response(None)
+
+    student_number = request.user.student_id
 
     # Save the preference
     if request.method == 'POST':
-        # Remove any previous preference
-        Preference.objects.filter(student=request.user.student).delete()
-
         content = json.loads(request.body)
 
-        if isinstance(content, dict) and 'student_number' in content:
-            student_number = int(content['student_number'])
+        if isinstance(content, dict) and 'student_number' in content \
+            and int(content['student_number']) <> student_number:
+            preference = save_preference(student_number, int(content['student_number']))
+            if preference is None:
+                return json_response(None, status=404)
+        else:
+            # Remove any previous preference, which ends its twin
+            with transaction.atomic():
+                lock_students([student_number], 'student_number')
+                Twin.objects.end(student_number)
+                Preference.objects.filter(student_id=student_number).delete()
+            preference = None
 
-            if student_number <> request.user.student.student_number:
-                preference = Preference()
-                preference.student = request.user.student
-                preference.preference_for = Student.objects.get(student_number=student_number)
-                preference.save()
+        return json_response(preference)
 
-                # Also save as history
-                prefhistory = PreferenceHistory()
-                prefhistory.student = request.user.student
-                prefhistory.preference_for = Student.objects.get(student_number=student_number)
-                prefhistory.save()
+    # Find the preference, with the preference of the other student to see if it is reciprocal
+    preference = Preference.objects.filter(student_id=student_number).order_by().values_list(
+        'preference_for_id', 'preference_for__name', 'preference_for__preference__preference_for_id').first()
 
+    if preference is None:
+        return json_response(None)
 
-    # Find the preference
-    try:
-        preference = Preference.objects.get(student=request.user.student)
-    except Preference.DoesNotExist:
-        return HttpResponse(json.dumps(None), content_type='application/json')
-
-    # Output to user
-    preference_json = {
-        'student_number': preference.preference_for.student_number,
-        'name': preference.preference_for.name
+    preference_for, name, their_preference_for = preference
+    return json_response(preference_json(preference_for, name, their_preference_for == student_number))
+
+def preference_json(student_number, name, reciprocal):
+    preference = {
+        'student_number': student_number,
+        'name': name
     }
 
-    if Preference.objects.filter(student=preference.preference_for, preference_for=request.user.student):
-        preference_json['reciprocal'] = True
+    if reciprocal:
+        preference['reciprocal'] = True
+
+    return preference
+
+def lock_students(student_numbers, *fields):
+    """
+    Lock the rows of the students until the transaction ends, in the order of their student
+    numbers so two requests that lock the same students can't wait for eachother.
+    Returns the `fields` of the students like values_list does, in the same query.
+    """
+    return list(Student.objects.select_for_update().filter(student_number__in=student_numbers)
+                .order_by('student_number').values_list(*fields))
+
+def save_preference(student_number, preference_for):
+    """
+    Save that `student_number` has `preference_for` as preference, also in the history.
+    Returns the preference like the GET of api_preference does, or None if there is
+    no student `preference_for`.
+
+    It takes three queries: one to lock both students and look up their current
+    preferences, one to insert or update the preference and one for the history.
+    Starting or ending a twin takes one more query each.
 
-    return HttpResponse(json.dumps(preference_json), content_type='application/json')
+    Every save locks the student and the student it chooses, so a concurrent save or removal
+    that could make or break their twin waits for this one and sees its preference.
+    """
+    with transaction.atomic():
+        students = dict(
+            (row[0], row[1:])
+            for row in lock_students([student_number, preference_for],
+                'student_number', 'name', 'preference__id', 'preference__preference_for_id',
+                'preference__preference_for__preference__preference_for_id'))
 
+        if preference_for not in students or student_number not in students:
+            return None
 
+        name, their_preference_id, their_preference_for, _ = students[preference_for]
+        _, own_preference_id, own_preference_for, own_preference_reciprocal_for = students[student_number]
+
+        changed = own_preference_for != preference_for
+        was_twin = own_preference_for is not None and own_preference_reciprocal_for == student_number
+        is_twin = their_preference_for == student_number
+
+        if own_preference_id is None:
+            Preference.objects.create(student_id=student_number, preference_for_id=preference_for)
+        else:
+            Preference.objects.filter(id=own_preference_id).update(preference_for_id=preference_for)
+        PreferenceHistory.objects.create(student_id=student_number, preference_for_id=preference_for)
+        if changed and was_twin:
+            Twin.objects.end(student_number, own_preference_for)
+        if changed and is_twin:
+            Twin.objects.start(student_number, preference_for)
+
+    return preference_json(preference_for, name, their_preference_for == student_number)
 
 """
-Returns a list of students that the logged in student can
+All students as a list of (student_number, name, <JSON of the student>) ordered by name.
+The JSON is kept in the cache and in this process until any Student changes.
+"""
+roster = (None, [])
+
+def get_roster():
+    global roster
+
+    version = students_version()
+    if roster[0] != version:
+        key = 'twin:students:roster:{0}'.format(version)
+        students = cache.get(key)
+        if students is None:
+            students = [(student_number, name, dumps({'student_number': student_number, 'name': name}))
+                        for student_number, name in Student.objects.values_list('student_number', 'name')]
+            cache.set(key, students, 24 * 60 * 60)
+        roster = (version, students)
+
+    return roster
+
+def reciprocal_json(student_json):
+    return student_json[:-1] + ', "reciprocal": true}'
+
+def fold(text):
+    """
+    Lowercase and remove accents, so names are found regardless of case and accents
+    """
+    return u''.join(c for c in unicodedata.normalize('NFKD', unicode(text)) if not unicodedata.combining(c)).lower()
+
+"""
+The index used to search students, built once per version of the roster.
+It has a dict with the roster position and JSON of every student, and two
+sorted lists of (<folded text>, student_number): one of the full names and
+one with every word of a name up to its end, so 'Bob van der Putten' is
+found with 'put'.
+"""
+search_index = (None, None)
+
+def get_search_index():
+    global search_index
+
+    version, students = get_roster()
+    if search_index[0] != version:
+        names = []
+        words = []
+        for student_number, name, student_json in students:
+            folded = fold(name)
+            names.append((folded, student_number))
+
+            parts = folded.split()
+            for i in range(1, len(parts)):
+                words.append((u' '.join(parts[i:]), student_number))
+
+        names.sort()
+        words.sort()
+        lookup = dict((student_number, (position, student_json))
+                      for position, (student_number, name, student_json) in enumerate(students))
+        search_index = (version, (lookup, names, words))
+
+    return search_index
+
+def search_students(index, query, limit, exclude):
+    """
+    Get at most `limit` student numbers whose name starts with the query, followed by
+    those with a later word in their name starting with it
+    """
+    lookup, names, words = index
+    query = fold(query)
+
+    found = []
+    for entries in (names, words):
+        i = bisect.bisect_left(entries, (query,))
+        while i < len(entries) and len(found) < limit and entries[i][0].startswith(query):
+            student_number = entries[i][1]
+            if student_number != exclude and student_number not in found:
+                found.append(student_number)
+            i += 1
+
+    return found
+
+def get_reciprocal(user):
+    """
+    Get the student number of the user and a set with the student numbers of
+    everyone that chose the user as their preference
+    """
+    if not user.student:
+        return None, set()
+
+    student_number = user.student.student_number
+    return student_number, set(Preference.objects.filter(preference_for_id=student_number).order_by().values_list('student_id', flat=True))
+
+"""
+Returns a list of students that the logged in student can choose from,
+the students that chose the logged in student are marked as reciprocal.
+
+The response has an ETag, so unchanged lists are answered with 304 Not Modified.
 """
 @login_required
 def api_students(request):
-    if request.user.student:
-        student_number = request.user.student.student_number
-        students = Student.objects.raw('SELECT student_number, name, EXISTS(SELECT 1 FROM twin_preference WHERE student_id=student_number AND preference_for_id=%s) AS reciprocal FROM twin_student WHERE student_number<>%s ORDER BY name', [student_number, student_number])
+    version, students = get_roster()
+    student_number, reciprocal = get_reciprocal(request.user)
+
+    etag = quote_etag(hashlib.md5('{0}:{1}:{2}'.format(
+        version, student_number, ','.join(str(n) for n in sorted(reciprocal)))).hexdigest())
+
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
     else:
-        students = Student.objects.all().order_by('name')
+        response = json_array_response([
+            reciprocal_json(student_json) if n in reciprocal else student_json
+            for n, name, student_json in students if n != student_number])
+
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+"""
+GET: Search the students the logged in student can choose from, with the parameters:
+     q:     the start of the name, or of a later word in it. Case and accents are ignored
+     limit: the maximum number of students returned, at most 50 (default 10)
+
+     Returns a list like /api/students does. Without `q` it returns the students
+     that chose the logged in student.
+"""
+@login_required
+def api_students_search(request):
+    try:
+        limit = min(max(int(request.GET.get('limit', 10)), 1), 50)
+    except ValueError:
+        limit = 10
+
+    version, index = get_search_index()
+    lookup = index[0]
+    student_number, reciprocal = get_reciprocal(request.user)
+
+    query = request.GET.get('q', '').strip()
+    if query:
+        found = search_students(index, query, limit, student_number)
+    else:
+        found = chosen_by(lookup, reciprocal)[:limit]
+
+    return raw_json_response(students_json(lookup, found, reciprocal))
+
+def chosen_by(lookup, reciprocal):
+    """
+    The student numbers of the students that chose the user, in the order of the roster
+    """
+    return sorted((n for n in reciprocal if n in lookup), key=lambda n: lookup[n][0])
+
+def students_json(lookup, student_numbers, reciprocal):
+    return json_array(reciprocal_json(lookup[n][1]) if n in reciprocal else lookup[n][1]
+                      for n in student_numbers)
+
+"""
+GET: Everything the page needs when it opens, in one request:
+     {
+        'user': <like /api/user>,
+        'preference': <like the GET of /api/preference>,
+        'students': <all the students that chose the user, like /api/students/search without `q`>
+     }
+     The preference and the students that chose the user come from a single query.
+"""
+@login_required
+def api_bootstrap(request):
+    version, index = get_search_index()
+    lookup = index[0]
 
-    def make_json(student):
-        data = {'name': student.name, 'student_number': student.student_number}
-        if hasattr(student, 'reciprocal') and student.reciprocal:
-            data['reciprocal'] = True
-        return data
+    preference = None
+    reciprocal = set()
+    student_number = request.user.student_id
+    if student_number:
+        for student_id, preference_for, name in Preference.objects.filter(
+                Q(student_id=student_number) | Q(preference_for_id=student_number)
+            ).order_by().values_list('student_id', 'preference_for_id', 'preference_for__name'):
+            if student_id == student_number:
+                preference = (preference_for, name)
+            else:
+                reciprocal.add(student_id)
 
-    students = [make_json(student) for student in students]
+    if preference is not None:
+        preference = preference_json(preference[0], preference[1], preference[0] in reciprocal)
 
-    return HttpResponse(json.dumps(students), content_type='application/json')
+    return raw_json_response('{{"user": {0}, "preference": {1}, "students": {2}}}'.format(
+        dumps(user_json(request.user)), dumps(preference),
+        students_json(lookup, chosen_by(lookup, reciprocal), reciprocal)))